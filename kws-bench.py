@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+"""
+kws-bench.py – Benchmarks
+Verfügbare Benchmarks:
+  merge [--sizes 1000,5000,20000] [--compare]
+      Misst die Dauer von merge_contacts (ADDLIST-Zusammenführung) in Abhängigkeit
+      von der Listengröße. Beide Listen überlappen sich zur Hälfte.
+      Mit --compare wird zusätzlich die frühere verschachtelte Schleife gemessen
+      (nur bis 5000 Kontakte, da quadratisch).
+  book [--size 100000] [--lookups 10000]
+      Vergleicht contaktd.cdf (Text) und contaktd.cdb (binär, mmap): Dauer bis der
+      Kontaktspeicher bereit ist, belegter Python-Speicher und Nachschlagen nach auth_id/Name.
+  nodes [--nodes 3] [--base-port 15000] [--server-mode thread|asyncio] [--node-workers 1] ...
+      Startet N kws.py-Knoten auf 127.0.0.1 mit eigenen Ports (KWS_PORT) und Datenordnern
+      (KWS_DATA_DIR) und treibt sie als simulierte Gegenstellen an: PING-Runden, MSG-Flut,
+      ADDLIST/LIST-Austausch und das Nachsenden einer Ausgangswarteschlange. MSG und REQ
+      tragen wie bei echten Sendern Nachrichten-IDs, laufen also durch die Duplikaterkennung.
+      --node-workers startet jeden Knoten mit so vielen Server-Prozessen (workers).
+      Ausgegeben werden Anfragen/s, p50/p99-Latenz und der Speicherverbrauch (RSS) je Knoten
+      (bei mehreren Server-Prozessen nur der Hauptprozess).
+"""
+
+import argparse
+import importlib.util
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import kws_cdb
+import kws_proto
+from kws_contacts import ContactStore, format_contacts, merge_contacts
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def make_contacts(start, count, day):
+    return [{
+        "username": f"user{i}",
+        "auth_id": f"auth-{i:08d}",
+        "last_contact": f"2025-01-{day:02d} {random.randint(0, 23):02d}:00:00",
+        "user_defined_name": f"name{i}",
+        "ip_address": f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}",
+        "status": "offline",
+    } for i in range(start, start + count)]
+
+def quadratic_merge(existing, new):
+    # Frühere Implementierung als Vergleich
+    for new_contact in new:
+        found = False
+        for contact in existing:
+            if contact["auth_id"] == new_contact["auth_id"]:
+                found = True
+                if new_contact["last_contact"] > contact["last_contact"]:
+                    contact["last_contact"] = new_contact["last_contact"]
+                break
+        if not found:
+            existing.append(new_contact)
+    return existing
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+def bench_merge(args):
+    sizes = [int(x) for x in args.sizes.split(",")]
+    print(f"{'Kontakte':>10} {'merge_contacts':>16} {'ContactStore':>14} {'quadratisch':>13}")
+    for n in sizes:
+        existing = make_contacts(0, n, 1)
+        new = make_contacts(n // 2, n, 2)
+        t_list = timed(merge_contacts, [dict(c) for c in existing], new)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "contaktd.cdf")
+            with open(path, "w") as f:
+                f.write(format_contacts(existing))
+            store = ContactStore(path)
+            t_store = timed(store.merge, new)
+        t_quad = "-"
+        if args.compare and n <= 5000:
+            t_quad = f"{timed(quadratic_merge, [dict(c) for c in existing], new) * 1000:.1f} ms"
+        print(f"{n:>10} {t_list * 1000:>13.1f} ms {t_store * 1000:>11.1f} ms {t_quad:>13}")
+
+def bench_book(args):
+    contacts = make_contacts(0, args.size, 1)
+    keys = [random.randrange(args.size) for _ in range(args.lookups)]
+    print(f"{args.size} Kontakte, {args.lookups} Abfragen je Art")
+    print(f"{'Format':<8} {'Datei':>10} {'Start':>10} {'Speicher':>10} {'get':>10} {'by_name':>10}")
+    with tempfile.TemporaryDirectory() as tmp:
+        text_path = os.path.join(tmp, "contaktd.cdf")
+        with open(text_path, "w") as f:
+            f.write(format_contacts(contacts))
+        binary_path = os.path.join(tmp, "contaktd.cdb")
+        kws_cdb.write_book(binary_path, contacts)
+        for name, path in (("text", text_path), ("binär", binary_path)):
+            t_open = timed(ContactStore, path)
+            tracemalloc.start()
+            store = ContactStore(path)
+            memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            t_get = timed(lambda: [store.get(f"auth-{i:08d}") for i in keys])
+            t_name = timed(lambda: [store.by_name(f"name{i}") for i in keys])
+            print(f"{name:<8} {os.path.getsize(path) / 1e6:>7.1f} MB {t_open * 1000:>7.1f} ms "
+                  f"{memory / 1e6:>7.1f} MB {t_get * 1000:>7.1f} ms {t_name * 1000:>7.1f} ms")
+
+# --- Mehrknoten-Benchmark ---
+
+class Node:
+    def __init__(self, index, port, data_dir, server_mode, workers=1):
+        self.index = index
+        self.port = port
+        self.address = f"127.0.0.1:{port}"
+        self.data_dir = data_dir
+        os.makedirs(data_dir, exist_ok=True)
+        with open(os.path.join(data_dir, "config.cfk"), "w") as f:
+            # Ohne Zulassungskontrolle, sonst bremst sie die Flut von 127.0.0.1 aus
+            f.write(f"username=bench{index}\nping_interval=3600\nserver_mode={server_mode}\nrate_limit=off\n"
+                    f"workers={workers}\n")
+        env = dict(os.environ, KWS_DATA_DIR=data_dir, KWS_PORT=str(port))
+        self.process = subprocess.Popen([sys.executable, os.path.join(SCRIPT_DIR, "kws.py")], env=env,
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.auth_key = None
+
+    def wait_ready(self, timeout=10):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=1).close()
+                with open(os.path.join(self.data_dir, "auth.key")) as f:
+                    self.auth_key = f.read().strip()
+                return
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError(f"Knoten {self.index} (Port {self.port}) startet nicht")
+
+    def rss_kb(self):
+        # Nur unter Linux verfügbar (/proc)
+        try:
+            with open(f"/proc/{self.process.pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1])
+        except OSError:
+            pass
+        return None
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+def percentile(samples, p):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+def timed_exchange(address, message):
+    host, port = kws_proto.split_address(address)
+    start = time.perf_counter()
+    kws_proto.exchange(host, port, message)
+    return time.perf_counter() - start
+
+def run_phase(name, jobs, workers):
+    # jobs: Liste von (adresse, nachricht); liefert eine Ergebniszeile
+    latencies = []
+    errors = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(timed_exchange, address, message) for address, message in jobs]
+        for future in futures:
+            try:
+                latencies.append(future.result())
+            except Exception:
+                errors += 1
+    elapsed = time.perf_counter() - start
+    return (name, len(jobs), errors, elapsed, latencies)
+
+def print_results(results):
+    print(f"{'Phase':<14} {'Anfragen':>9} {'Fehler':>7} {'Dauer':>9} {'Anfr./s':>10} {'p50':>9} {'p99':>9}")
+    for name, count, errors, elapsed, latencies in results:
+        rate = count / elapsed if elapsed else 0.0
+        print(f"{name:<14} {count:>9} {errors:>7} {elapsed:>8.2f}s {rate:>10.0f} "
+              f"{percentile(latencies, 50) * 1000:>7.2f}ms {percentile(latencies, 99) * 1000:>7.2f}ms")
+
+def replay_phase(nodes, per_node, root):
+    # Ausgangswarteschlange eines simulierten Clients füllen und mit dem Code aus
+    # kws-client.py nachsenden lassen
+    client_dir = os.path.join(root, "client")
+    os.makedirs(client_dir, exist_ok=True)
+    os.environ["KWS_DATA_DIR"] = client_dir
+    spec = importlib.util.spec_from_file_location("kws_client", os.path.join(SCRIPT_DIR, "kws-client.py"))
+    client = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(client)
+    for node in nodes:
+        for i in range(per_node):
+            client.outbox.enqueue(node.address, kws_proto.with_id(f"MSG;bench-client;2025-01-01 00:00:00;nachgesendet {i}"))
+    start = time.perf_counter()
+    client.resend_queued_messages("bench-client")
+    elapsed = time.perf_counter() - start
+    errors = client.outbox.depth()
+    client.log_writer.close()
+    return ("replay", per_node * len(nodes), errors, elapsed, [])
+
+def bench_nodes(args):
+    root = tempfile.mkdtemp(prefix="kws-bench-")
+    nodes = [Node(i, args.base_port + i, os.path.join(root, f"node{i}"), args.server_mode, args.node_workers)
+             for i in range(args.nodes)]
+    try:
+        for node in nodes:
+            node.wait_ready()
+        results = []
+        sweep = [(node.address, "PING;bench") for node in nodes]
+        results.append(run_phase("ping-sweep", sweep * args.sweeps, args.workers))
+        flood = [(node.address, kws_proto.with_id(f"MSG;bench;2025-01-01 00:00:00;flut {i}"))
+                 for node in nodes for i in range(args.messages)]
+        results.append(run_phase("msg-flood", flood, args.workers))
+        book = format_contacts(make_contacts(0, args.book, 1)).strip()
+        results.append(run_phase("addlist", [(n.address, kws_proto.with_id(f"REQ;bench;{n.auth_key};ADDLIST;{book}"))
+                                             for n in nodes], args.workers))
+        results.append(run_phase("list", [(n.address, kws_proto.with_id(f"REQ;bench;{n.auth_key};LIST"))
+                                          for n in nodes for _ in range(args.lists)], args.workers))
+        results.append(replay_phase(nodes, args.queued, root))
+        print(f"{len(nodes)} Knoten, server_mode={args.server_mode}, workers={args.node_workers}, "
+              f"{args.workers} simulierte Gegenstellen")
+        print_results(results)
+        print("Speicher je Knoten (RSS):")
+        for node in nodes:
+            rss = node.rss_kb()
+            print(f"  Knoten {node.index} ({node.address}): " + (f"{rss / 1024:.1f} MB" if rss else "n/a"))
+    finally:
+        for node in nodes:
+            node.stop()
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+        else:
+            print(f"Datenordner: {root}")
+
+def main():
+    parser = argparse.ArgumentParser(description="KWS-Benchmarks")
+    sub = parser.add_subparsers(dest="benchmark", required=True)
+    p_merge = sub.add_parser("merge", help="Dauer von merge_contacts nach Listengröße")
+    p_merge.add_argument("--sizes", default="1000,5000,20000,50000")
+    p_merge.add_argument("--compare", action="store_true", help="frühere quadratische Version mitmessen")
+    p_merge.set_defaults(func=bench_merge)
+    p_book = sub.add_parser("book", help="Kontaktbuch als Text oder binär (mmap)")
+    p_book.add_argument("--size", type=int, default=100000)
+    p_book.add_argument("--lookups", type=int, default=10000)
+    p_book.set_defaults(func=bench_book)
+    p_nodes = sub.add_parser("nodes", help="mehrere Knoten auf 127.0.0.1 starten und belasten")
+    p_nodes.add_argument("--nodes", type=int, default=3)
+    p_nodes.add_argument("--base-port", type=int, default=15000)
+    p_nodes.add_argument("--server-mode", choices=["thread", "asyncio"], default="thread")
+    p_nodes.add_argument("--workers", type=int, default=16, help="gleichzeitige simulierte Gegenstellen")
+    p_nodes.add_argument("--node-workers", type=int, default=1, help="Server-Prozesse je Knoten (workers in config.cfk)")
+    p_nodes.add_argument("--sweeps", type=int, default=50, help="PING-Runden über alle Knoten")
+    p_nodes.add_argument("--messages", type=int, default=2000, help="MSG je Knoten")
+    p_nodes.add_argument("--book", type=int, default=5000, help="Kontakte im ADDLIST-Payload")
+    p_nodes.add_argument("--lists", type=int, default=20, help="LIST-Anfragen je Knoten")
+    p_nodes.add_argument("--queued", type=int, default=500, help="nachzusendende Nachrichten je Knoten")
+    p_nodes.add_argument("--keep", action="store_true", help="Datenordner nicht löschen")
+    p_nodes.set_defaults(func=bench_nodes)
+    args = parser.parse_args()
+    random.seed(1)
+    args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,27 +1,44 @@
 #!/usr/bin/env python3
 """
 kws-client.py – Client
-- Lädt den lokalen Auth-Key und liest die Kontakte aus der Datei contaktd.cdf.
+- Lädt den lokalen Auth-Key und hält die Kontakte aus contaktd.cdf im Kontaktspeicher (kws_contacts.py).
 - Sendet in regelmäßigen Abständen (REQUEST_INTERVAL) an jeden Kontakt REQ-Anfragen (z. B. INFO).
 - Unterstützt erweiterte REQ-Befehle (z. B. LIST).
-- Wenn der Versand fehlschlägt, werden die Nachrichten in data.ksys zwischengespeichert.
-- Ein Hintergrund-Thread versucht periodisch, die zwischengespeicherten Nachrichten zu senden.
+- Nutzt das gerahmte Protokoll (kws_proto.py) über einen Verbindungspool je Gegenstelle,
+  sodass die periodischen Anfragen warme Verbindungen wiederverwenden.
+- Wenn der Versand fehlschlägt, werden die Nachrichten in der Ausgangswarteschlange
+  (outbox/, kws_queue.py) je Ziel zwischengespeichert.
+- Ein Hintergrund-Thread stellt die Rückstände periodisch zu: je Ziel in BATCH-Frames mit
+  einer Sammelbestätigung (ältere Gegenstellen: gepipelined); Ziele im Backoff (exponentiell nach Fehlschlägen) werden übersprungen.
 """
 
 import os
-import socket
 import time
-from datetime import datetime
 import threading
+from datetime import datetime, timedelta
+
+import kws_contacts
+import kws_proto
+from kws_contacts import TIME_FORMAT, ContactStore
+from kws_log import LogWriter
+from kws_queue import Outbox
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
-AUTH_KEY_FILE = os.path.join(SCRIPT_DIR, "auth.key")
-CONTACT_FILE = os.path.join(SCRIPT_DIR, "contaktd.cdf")
-DATATRANS_FILE = os.path.join(SCRIPT_DIR, "datatrans.ksys")
-DATA_FILE = os.path.join(SCRIPT_DIR, "data.ksys")
+# KWS_DATA_DIR erlaubt einen eigenen Datenordner, z. B. für mehrere Knoten auf einem Rechner
+DATA_DIR = os.environ.get("KWS_DATA_DIR", SCRIPT_DIR)
+AUTH_KEY_FILE = os.path.join(DATA_DIR, "auth.key")
+CONTACT_FILE = kws_contacts.contact_file(DATA_DIR)  # contaktd.cdb, falls umgewandelt, sonst contaktd.cdf
+DATATRANS_FILE = os.path.join(DATA_DIR, "datatrans.ksys")
+DATA_FILE = os.path.join(DATA_DIR, "data.ksys")  # altes Format, wird beim Start übernommen
+OUTBOX_DIR = os.path.join(DATA_DIR, "outbox")
 
 SERVER_PORT = 5000
 REQUEST_INTERVAL = 30
+RESEND_BATCH = kws_proto.BATCH_MAX  # Nachrichten pro Block (ein BATCH-Frame) bei der Zustellung eines Rückstands
+
+contact_store = ContactStore(CONTACT_FILE)
+outbox = Outbox(OUTBOX_DIR)
+log_writer = LogWriter(DATATRANS_FILE)
 
 def load_auth_key():
     if os.path.exists(AUTH_KEY_FILE):
@@ -31,91 +48,82 @@ def load_auth_key():
         print("Auth-Key nicht gefunden. Bitte starte zuerst kws.py.")
         exit(1)
 
-def load_contacts():
-    contacts = []
-    if os.path.exists(CONTACT_FILE):
-        with open(CONTACT_FILE, "r") as f:
-            for line in f:
-                line = line.strip()
-                if line:
-                    if line.endswith("|"):
-                        line = line[:-1]
-                    parts = line.split(";")
-                    if len(parts) >= 6:
-                        contact = {
-                            "username": parts[0],
-                            "auth_id": parts[1],
-                            "last_contact": parts[2],
-                            "user_defined_name": parts[3],
-                            "ip_address": parts[4],
-                            "status": parts[5]
-                        }
-                        contacts.append(contact)
-    return contacts
-
 def log_message(message):
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    with open(DATATRANS_FILE, "a") as f:
-        f.write(f"[{timestamp}] {message}\n")
+    log_writer.write(message)
 
 def queue_unsent_message(target_ip, message):
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    with open(DATA_FILE, "a") as f:
-        f.write(f"{target_ip}|{message}|{timestamp}\n")
+    outbox.enqueue(target_ip, message)
     log_message(f"Nachricht an {target_ip} in Warteschlange gestellt.")
 
 def send_request_to_target(target_ip, request_msg):
     try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.settimeout(5)
-        s.connect((target_ip, SERVER_PORT))
-        s.sendall(request_msg.encode("utf-8"))
-        reply = s.recv(4096).decode("utf-8")
+        reply = kws_proto.exchange(*kws_proto.split_address(target_ip, SERVER_PORT), request_msg)
         log_message(f"Antwort von {target_ip}: {reply}")
-        s.close()
         return True
     except Exception as e:
         log_message(f"Fehler bei Anfrage an {target_ip}: {e}")
         return False
 
 def request_info(auth_key):
-    contacts = load_contacts()
-    for contact in contacts:
-        target_ip = contact["ip_address"]
-        request_msg = f"REQ;{auth_key};{contact['auth_id']};INFO"
-        if not send_request_to_target(target_ip, request_msg):
-            queue_unsent_message(target_ip, request_msg)
+    # INFO nur an Kontakte, die online gelten, aber seit REQUEST_INTERVAL nicht aktiv waren;
+    # offline Kontakte prüft kws.py mit Backoff, kürzlich aktive brauchen keine Anfrage.
+    threshold = (datetime.now() - timedelta(seconds=REQUEST_INTERVAL)).strftime(TIME_FORMAT)
+    for contact in contact_store.all():
+        if contact["status"] != "online" or contact["last_contact"] >= threshold:
+            continue
+        request_msg = kws_proto.with_id(f"REQ;{auth_key};{contact['auth_id']};INFO")
+        if send_request_to_target(contact["ip_address"], request_msg):
+            contact_store.touch(contact["auth_id"])
+
+def deliver_backlog(target_ip, entries, auth_key):
+    # Gesamten Rückstand eines Ziels blockweise zustellen: reine MSG-Blöcke als ein
+    # BATCH-Frame, sonst gepipelined über eine (gepoolte) Verbindung. Nach jedem Block
+    # wird der Fortschritt bis zum ersten nicht angenommenen Eintrag vermerkt.
+    host, port = kws_proto.split_address(target_ip, SERVER_PORT)
+    for start in range(0, len(entries), RESEND_BATCH):
+        batch = entries[start:start + RESEND_BATCH]
+        if all(kws_proto.is_msg(msg) for _, msg in batch):
+            accepted = set(kws_proto.send_batch(host, port, auth_key, batch))
+        else:
+            replies = kws_proto.send_many(host, port, [msg for _, msg in batch])
+            for reply in replies:
+                log_message(f"Antwort von {target_ip}: {reply}")
+            # Mit BUSY abgewiesene Einträge bleiben in der Warteschlange
+            accepted = {offset for (offset, _), reply in zip(batch, replies) if reply != "BUSY"}
+        delivered = 0
+        for offset, _ in batch:
+            if offset not in accepted:
+                break
+            delivered = offset
+        if delivered:
+            outbox.mark_delivered(target_ip, delivered)
+        log_message(f"{len(accepted)} von {len(batch)} Nachrichten an {target_ip} zugestellt.")
+        if delivered != batch[-1][0]:
+            raise RuntimeError(f"{len(batch) - len(accepted)} Nachrichten nicht angenommen")
 
 def resend_queued_messages(auth_key):
-    if not os.path.exists(DATA_FILE):
-        return
-    try:
-        with open(DATA_FILE, "r") as f:
-            lines = f.readlines()
-    except Exception:
-        return
-    unsent = []
-    for line in lines:
-        line = line.strip()
-        if not line:
+    # Nur Ziele, deren Backoff abgelaufen ist; Fehlschläge verlängern das Backoff
+    for target_ip in outbox.due():
+        entries = outbox.pending(target_ip)
+        if not entries:
             continue
-        parts = line.split("|")
-        if len(parts) >= 2:
-            target_ip = parts[0]
-            request_msg = parts[1]
-            if not send_request_to_target(target_ip, request_msg):
-                unsent.append(line)
-    with open(DATA_FILE, "w") as f:
-        for item in unsent:
-            f.write(item + "\n")
+        try:
+            deliver_backlog(target_ip, entries, auth_key)
+        except Exception as e:
+            delay = outbox.mark_failed(target_ip)
+            log_message(f"Fehler bei Anfrage an {target_ip}: {e} (nächster Versuch in bis zu {delay} s)")
 
 def resend_loop(auth_key):
     while True:
         resend_queued_messages(auth_key)
+        kws_proto.pool.close_idle()
         time.sleep(REQUEST_INTERVAL)
 
 def main():
     auth_key = load_auth_key()
+    imported = outbox.import_legacy_file(DATA_FILE)
+    if imported:
+        log_message(f"{imported} Nachrichten aus data.ksys in die Ausgangswarteschlange übernommen.")
     print("kws-client.py läuft – sende periodisch Anfragen an alle Kontakte.")
     threading.Thread(target=resend_loop, args=(auth_key,), daemon=True).start()
     while True:
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+kws-convert.py – Kontaktbuch umwandeln
+  to-binary
+      Schreibt contaktd.cdf (inkl. Journal contaktd.jrn) als binäres Kontaktbuch contaktd.cdb.
+      Danach verwenden kws.py, kws-client.py und kws-service.py automatisch contaktd.cdb.
+  to-text
+      Schreibt contaktd.cdb (inkl. Journal) zurück nach contaktd.cdf.
+Die bisherige Datei bleibt als .bak erhalten. kws.py, kws-client.py und kws-service.py
+vorher beenden, damit währenddessen niemand ins Journal schreibt.
+"""
+
+import argparse
+import os
+import sys
+
+import kws_cdb
+from kws_contacts import ContactStore, format_contacts
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def convert(data_dir, to_binary):
+    text_path = os.path.join(data_dir, "contaktd.cdf")
+    binary_path = os.path.join(data_dir, "contaktd.cdb")
+    src, dst = (text_path, binary_path) if to_binary else (binary_path, text_path)
+    if not os.path.exists(src):
+        print(f"{src} nicht gefunden.")
+        return 1
+    store = ContactStore(src)
+    contacts = store.all()
+    store.close()  # .cdb freigeben, Windows benennt eingeblendete Dateien nicht um
+    tmp_path = dst + ".tmp"
+    if to_binary:
+        kws_cdb.write_book(tmp_path, contacts)
+    else:
+        with open(tmp_path, "w") as f:
+            f.write(format_contacts(contacts))
+    os.replace(tmp_path, dst)
+    # Das Journal steckt jetzt im neuen Snapshot
+    if os.path.exists(store.journal_path):
+        open(store.journal_path, "w").close()
+    os.replace(src, src + ".bak")
+    print(f"{len(contacts)} Kontakte nach {dst} geschrieben, {src} gesichert als {src}.bak.")
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description="Kontaktbuch zwischen Text- und Binärformat umwandeln")
+    parser.add_argument("direction", choices=["to-binary", "to-text"])
+    parser.add_argument("--data-dir", default=os.environ.get("KWS_DATA_DIR", SCRIPT_DIR))
+    args = parser.parse_args()
+    return convert(args.data_dir, args.direction == "to-binary")
+
+if __name__ == "__main__":
+    sys.exit(main())
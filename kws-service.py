@@ -9,25 +9,59 @@ Verfügbare Befehle:
   List
       Listet alle in contaktd.cdf gespeicherten Kontakte auf.
   Message <user_defined_name> <Nachricht>
-      Sendet eine Nachricht an den angegebenen Kontakt.
-  Show
-      Zeigt den Inhalt der temporären Logdatei (datatrans.ksys) an.
+      Sendet eine Nachricht an den angegebenen Kontakt. Ist er direkt nicht erreichbar, wird sie
+      über einen online Kontakt weitergeleitet, der ihn zuletzt als online gemeldet hat (RELAY);
+      erst wenn auch das scheitert, kommt sie in die Ausgangswarteschlange. Wartende Nachrichten
+      an denselben Kontakt werden zusammen mit der neuen in einem BATCH-Frame gesendet.
+      Mehrere Empfänger durch Kommas getrennt (name1,name2,...) senden an eine Gruppe.
+  Broadcast [--online] <Nachricht>
+      Sendet die Nachricht an alle Kontakte (mit --online nur an die als online bekannten),
+      parallel mit höchstens 32 gleichzeitigen Sendungen. Danach eine Zusammenfassung:
+      zugestellt, weitergeleitet, in Warteschlange, Dauer.
+  Show [--last N] [--since <zeit>] [--from <name/auth-id>] [--follow] | Show --log [N]
+      Zeigt empfangene Nachrichten aus dem Posteingang (inbox.msg), ohne Angaben die letzten 20.
+      --since akzeptiert "YYYY-MM-DD", "YYYY-MM-DD HH:MM[:SS]" oder relativ (30m, 2h, 1d);
+      --follow zeigt danach laufend neue Nachrichten (STRG+C beendet).
+      --log zeigt die letzten N Zeilen der Logdatei datatrans.ksys (inkl. PING usw.).
+  Stats [<auth-id/user_defined_name>]
+      Zeigt die Laufzeitstatistik des eigenen kws.py (oder eines Kontakts) an.
   Request <auth-id/user_defined_name> <Befehl>
-      Sendet eine Anfrage an den Kontakt. Unterstützte Befehle: INFO, ADDLIST, LIST.
+      Sendet eine Anfrage an den Kontakt. Unterstützte Befehle: INFO, ADDLIST, LIST, SYNC, STATS.
       Bei ADDLIST wird die eigene Kontaktliste als Payload gesendet.
+      SYNC gleicht beide Kontaktlisten ab und überträgt nur die Unterschiede.
+Läuft kws.py, gehen alle Befehle über dessen Steuer-Socket (kws.sock, kws_control.py) und
+nutzen dessen Kontaktspeicher und Verbindungen; sonst arbeitet kws-service.py selbst mit den
+Dateien im Datenordner.
 """
 
 import os
-import socket
 import sys
+import time
 from datetime import datetime
 
+import kws_contacts
+import kws_control
+import kws_inbox
+import kws_proto
+import kws_relay
+from kws_contacts import ContactStore
+from kws_log import LogWriter
+from kws_queue import Outbox
+
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
-AUTH_KEY_FILE = os.path.join(SCRIPT_DIR, "auth.key")
-CONTACT_FILE = os.path.join(SCRIPT_DIR, "contaktd.cdf")
-DATATRANS_FILE = os.path.join(SCRIPT_DIR, "datatrans.ksys")
-DATA_FILE = os.path.join(SCRIPT_DIR, "data.ksys")
+# KWS_DATA_DIR erlaubt einen eigenen Datenordner, z. B. für mehrere Knoten auf einem Rechner
+DATA_DIR = os.environ.get("KWS_DATA_DIR", SCRIPT_DIR)
+AUTH_KEY_FILE = os.path.join(DATA_DIR, "auth.key")
+CONTACT_FILE = kws_contacts.contact_file(DATA_DIR)  # contaktd.cdb, falls umgewandelt, sonst contaktd.cdf
+DATATRANS_FILE = os.path.join(DATA_DIR, "datatrans.ksys")
+OUTBOX_DIR = os.path.join(DATA_DIR, "outbox")
+ROUTES_FILE = os.path.join(DATA_DIR, "routes.json")
+CONTROL_SOCKET = kws_control.socket_path(DATA_DIR)  # Steuer-Socket des laufenden kws.py
 SERVER_PORT = 5000
+RELAY_HOPS = 2  # max. Relay-Stationen für eine weitergeleitete Nachricht (0 = nicht weiterleiten)
+LOCAL_PORT = int(os.environ.get("KWS_PORT", SERVER_PORT))  # Port des eigenen kws.py
+SHOW_DEFAULT = 20  # so viele Nachrichten zeigt "Show" ohne Angaben
+FOLLOW_INTERVAL = 1  # Abfrageintervall von "Show --follow" (in Sekunden)
 
 def load_auth_key():
     if os.path.exists(AUTH_KEY_FILE):
@@ -37,38 +71,42 @@ def load_auth_key():
         print("Auth-Key nicht gefunden. Bitte installiere zuerst kws.")
         sys.exit(1)
 
-def load_contacts():
-    contacts = []
-    if os.path.exists(CONTACT_FILE):
-        with open(CONTACT_FILE, "r") as f:
-            for line in f:
-                line = line.strip()
-                if line:
-                    if line.endswith("|"):
-                        line = line[:-1]
-                    parts = line.split(";")
-                    if len(parts) >= 6:
-                        contact = {
-                            "username": parts[0],
-                            "auth_id": parts[1],
-                            "last_contact": parts[2],
-                            "user_defined_name": parts[3],
-                            "ip_address": parts[4],
-                            "status": parts[5]
-                        }
-                        contacts.append(contact)
-    return contacts
-
-def save_contact(contact):
-    contacts = load_contacts()
-    contacts.append(contact)
-    with open(CONTACT_FILE, "w") as f:
-        for c in contacts:
-            line = f"{c['username']};{c['auth_id']};{c['last_contact']};{c['user_defined_name']};{c['ip_address']};{c['status']}|"
-            f.write(line + "\n")
-
-def list_contacts():
-    contacts = load_contacts()
+def local_commands():
+    # Ohne laufenden kws.py: Kontaktbuch, Warteschlange und Log direkt aus dem Datenordner
+    auth_key = load_auth_key()
+    log_writer = LogWriter(DATATRANS_FILE)
+
+    def own_stats():
+        reply = kws_proto.exchange("127.0.0.1", LOCAL_PORT, kws_proto.with_id(f"REQ;{auth_key};{auth_key};STATS"))
+        return reply[len("STATS;"):] if reply.startswith("STATS;") else reply
+
+    def read_log(limit=0):
+        log_writer.flush()
+        if not os.path.exists(DATATRANS_FILE):
+            return []
+        with open(DATATRANS_FILE, "r") as f:
+            lines = f.read().splitlines()
+        return lines[-limit:] if limit else lines
+
+    return kws_control.Commands(auth_key, ContactStore(CONTACT_FILE), Outbox(OUTBOX_DIR),
+                                kws_relay.RouteCache(ROUTES_FILE), log_writer.write, own_stats, read_log,
+                                kws_inbox.Inbox(DATA_DIR), RELAY_HOPS)
+
+def open_client():
+    # Steuer-Socket von kws.py, falls er läuft, sonst dieselben Befehle im eigenen Prozess
+    client = kws_control.connect(CONTROL_SOCKET)
+    if client:
+        print("Verbunden mit kws.py.")
+        return client
+    return kws_control.LocalClient(local_commands())
+
+def print_log(lines):
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    for line in lines:
+        print(f"[{timestamp}] {line}")
+
+def list_contacts(client):
+    contacts, _ = client.call("list")
     if not contacts:
         print("Keine Kontakte gefunden.")
         return
@@ -76,56 +114,110 @@ def list_contacts():
     for c in contacts:
         print(f"Name: {c['user_defined_name']}, Auth-ID: {c['auth_id']}, IP: {c['ip_address']}, Status: {c['status']}, Letzter Kontakt: {c['last_contact']}")
 
-def log_message(message):
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    with open(DATATRANS_FILE, "a") as f:
-        f.write(f"[{timestamp}] {message}\n")
-    print(f"[{timestamp}] {message}")
+def show_stats(client, identifier=None):
+    if identifier is None:
+        try:
+            text, _ = client.call("stats")
+        except Exception as e:
+            print(f"Fehler bei der Anfrage an 127.0.0.1:{LOCAL_PORT}: {e}")
+            return
+        print(f"Statistik von 127.0.0.1:{LOCAL_PORT}:")
+        print(text)
+        return
+    result, lines = client.call("request", identifier=identifier, command="stats")
+    if result is None:
+        print("Kontakt nicht gefunden.")
+        return
+    reply = result["reply"]
+    if reply is None:
+        print_log(lines)
+    elif reply.startswith("STATS;"):
+        print(f"Statistik von {result['ip']}:")
+        print(reply[len("STATS;"):])
+    else:
+        print(f"Antwort von {result['ip']}: {reply}")
 
-def queue_unsent_message(target_ip, message):
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    with open(DATA_FILE, "a") as f:
-        f.write(f"{target_ip}|{message}|{timestamp}\n")
-    log_message(f"Nachricht an {target_ip} in Warteschlange gestellt.")
+def print_broadcast(result):
+    counts = result["counts"]
+    parts = [f"{counts[status]} {status}" for status in ("zugestellt", "weitergeleitet", "in Warteschlange", "abgelehnt", "fehlgeschlagen")
+             if counts.get(status)]
+    print(f"Gesendet an {result['targets']} Kontakte in {result['elapsed']:.2f} s: {', '.join(parts) or 'nichts gesendet'}.")
+    if result["failed"]:
+        print("Nicht direkt zugestellt: " + ", ".join(f"{name} ({status})" for name, status in result["failed"]))
+    if result["missing"]:
+        print("Nicht gefunden: " + ", ".join(result["missing"]))
 
-def send_request(target_ip, target_auth, command, auth_key, payload=""):
-    try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.settimeout(5)
-        s.connect((target_ip, SERVER_PORT))
-        req = f"REQ;{auth_key};{target_auth};{command.upper()}"
-        if payload:
-            req += f";{payload}"
-        s.sendall(req.encode("utf-8"))
-        reply = s.recv(4096).decode("utf-8")
-        log_message(f"Antwort von {target_ip}: {reply}")
-        s.close()
-    except Exception as e:
-        log_message(f"Fehler bei der Anfrage an {target_ip}: {e}")
-        queue_unsent_message(target_ip, f"REQ;{auth_key};{target_auth};{command.upper()}" + (f";{payload}" if payload else ""))
-
-def send_message(ip, message, auth_key):
-    try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.settimeout(5)
-        s.connect((ip, SERVER_PORT))
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        msg = f"MSG;{auth_key};{timestamp};{message}"
-        s.sendall(msg.encode("utf-8"))
-        reply = s.recv(4096).decode("utf-8")
-        if reply == "MSG_RECEIVED":
-            log_message(f"Nachricht an {ip} wurde bestätigt.")
-        s.close()
-    except Exception as e:
-        log_message(f"Fehler beim Senden an {ip}: {e}")
-        queue_unsent_message(ip, f"MSG;{auth_key};{datetime.now().strftime('%Y-%m-%d %H:%M:%S')};{message}")
-
-def show_messages():
-    if os.path.exists(DATATRANS_FILE):
-        with open(DATATRANS_FILE, "r") as f:
-            print(f.read())
-    else:
+def parse_since(text):
+    # "YYYY-MM-DD[ HH:MM[:SS]]" oder relativ "30m"/"2h"/"1d" -> Unix-Zeit
+    units = {"m": 60, "h": 3600, "d": 86400}
+    if text[-1:] in units and text[:-1].isdigit():
+        return time.time() - int(text[:-1]) * units[text[-1]]
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(text.replace("T", " "), fmt).timestamp()
+        except ValueError:
+            pass
+    raise ValueError(f"Ungültige Zeitangabe: {text}")
+
+def parse_show_args(args):
+    options = {"last": 0, "since": None, "sender_name": None, "follow": False, "log": None}
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg == "--follow":
+            options["follow"] = True
+        elif arg == "--log":
+            options["log"] = 0
+            if i + 1 < len(args) and args[i + 1].isdigit():
+                i += 1
+                options["log"] = int(args[i])
+        elif arg in ("--last", "--since", "--from") and i + 1 < len(args):
+            i += 1
+            value = args[i]
+            if arg == "--last":
+                options["last"] = int(value)
+            elif arg == "--from":
+                options["sender_name"] = value
+            else:
+                # Uhrzeit als eigenes Wort: "--since 2026-01-31 12:00"
+                if i + 1 < len(args) and ":" in args[i + 1] and not args[i + 1].startswith("--"):
+                    i += 1
+                    value += " " + args[i]
+                options["since"] = parse_since(value)
+        else:
+            raise ValueError(f"Unbekannte Option: {arg}")
+        i += 1
+    if not (options["last"] or options["since"] or options["sender_name"] or options["follow"]):
+        options["last"] = SHOW_DEFAULT
+    return options
+
+def print_messages(messages):
+    for m in messages:
+        sender = m["name"] or m["from"]
+        print(f"[{m['time']}] {sender}: {m['text']} (gesendet {m['sent']})")
+
+def show_messages(client, args):
+    options = parse_show_args(args)
+    if options["log"] is not None:
+        lines, _ = client.call("log", limit=options["log"])
+        print("\n".join(lines) if lines else "Keine Log-Einträge vorhanden.")
+        return
+    result, _ = client.call("messages", since=options["since"], sender_name=options["sender_name"], last=options["last"])
+    if result["messages"]:
+        print_messages(result["messages"])
+    elif not options["follow"]:
         print("Keine Nachrichten vorhanden.")
+    if not options["follow"]:
+        return
+    position = result["count"]
+    try:
+        while True:
+            time.sleep(FOLLOW_INTERVAL)
+            result, _ = client.call("messages", since=options["since"], sender_name=options["sender_name"], after=position)
+            print_messages(result["messages"])
+            position = result["count"]
+    except KeyboardInterrupt:
+        pass
 
 def print_help():
     help_text = """
@@ -136,19 +228,29 @@ Verfügbare Befehle:
       Fügt einen neuen Kontakt hinzu. Danach werden weitere Details (Benutzername, Anzeigename, IP) abgefragt.
   List
       Listet alle Kontakte auf.
-  Message <user_defined_name> <Nachricht>
-      Sendet eine Nachricht an den angegebenen Kontakt.
-  Show
-      Zeigt alle empfangenen Nachrichten (datatrans.ksys).
+  Message <user_defined_name>[,<name2>,...] <Nachricht>
+      Sendet eine Nachricht an den angegebenen Kontakt (oder parallel an mehrere).
+  Broadcast [--online] <Nachricht>
+      Sendet eine Nachricht parallel an alle (online) Kontakte und zeigt eine Zusammenfassung.
+  Show [--last N] [--since <zeit>] [--from <name/auth-id>] [--follow]
+      Zeigt empfangene Nachrichten, ohne Angaben die letzten 20.
+      --since: "YYYY-MM-DD", "YYYY-MM-DD HH:MM[:SS]" oder relativ (30m, 2h, 1d).
+      --follow: zeigt laufend neue Nachrichten, bis STRG+C.
+  Show --log [N]
+      Zeigt die letzten N Zeilen der Logdatei datatrans.ksys (inkl. PING usw.).
+  Stats [<auth-id/user_defined_name>]
+      Zeigt die Laufzeitstatistik des eigenen kws.py (oder eines Kontakts) an:
+      Anfragen je Befehl, aktive Verbindungen, Bytes, Warteschlangentiefe, Latenzen.
   Request <auth-id/user_defined_name> <Befehl>
       Sendet eine Anfrage an den Kontakt.
-      Unterstützte Befehle: INFO, ADDLIST, LIST.
+      Unterstützte Befehle: INFO, ADDLIST, LIST, SYNC, STATS.
       Bei ADDLIST wird die eigene Kontaktliste als Payload gesendet.
+      SYNC gleicht beide Kontaktlisten ab und überträgt nur die Unterschiede.
 """
     print(help_text)
 
 def main():
-    auth_key = load_auth_key()
+    client = open_client()
     print("kws-service gestartet. Tippe 'Help' für Befehle.")
     while True:
         try:
@@ -177,62 +279,57 @@ def main():
                     "ip_address": ip_address,
                     "status": status
                 }
-                save_contact(contact)
+                client.call("add", contact=contact)
                 print("Kontakt hinzugefügt.")
             elif cmd == "list":
-                list_contacts()
+                list_contacts(client)
             elif cmd == "message":
                 if len(parts) < 3:
                     print("Usage: Message <user_defined_name> <Nachricht>")
                     continue
-                target_name = parts[1]
-                message_content = " ".join(parts[2:])
-                contacts = load_contacts()
-                target = None
-                for c in contacts:
-                    if c["user_defined_name"] == target_name:
-                        target = c
-                        break
-                if target:
-                    send_message(target["ip_address"], message_content, auth_key)
-                else:
+                if "," in parts[1]:
+                    names = [n for n in parts[1].split(",") if n]
+                    result, _ = client.call("broadcast", text=" ".join(parts[2:]), names=names)
+                    print_broadcast(result)
+                    continue
+                status, lines = client.call("message", name=parts[1], text=" ".join(parts[2:]))
+                if status is None:
                     print("Kontakt nicht gefunden.")
+                print_log(lines)
+            elif cmd == "broadcast":
+                online_only = len(parts) > 1 and parts[1] == "--online"
+                text = " ".join(parts[2:] if online_only else parts[1:])
+                if not text:
+                    print("Usage: Broadcast [--online] <Nachricht>")
+                    continue
+                result, _ = client.call("broadcast", text=text, online_only=online_only)
+                print_broadcast(result)
+            elif cmd == "stats":
+                show_stats(client, parts[1] if len(parts) >= 2 else None)
             elif cmd == "show":
-                show_messages()
+                show_messages(client, parts[1:])
             elif cmd == "request":
                 if len(parts) < 3:
                     print("Usage: Request <auth-id/user_defined_name> <Befehl>")
                     continue
-                target_identifier = parts[1]
-                req_command = parts[2].lower()
-                contacts = load_contacts()
-                target = None
-                for c in contacts:
-                    if c["auth_id"] == target_identifier or c["user_defined_name"] == target_identifier:
-                        target = c
-                        break
-                if target:
-                    if req_command == "addlist":
-                        # Lese die eigene Kontaktliste als Payload
-                        if os.path.exists(CONTACT_FILE):
-                            with open(CONTACT_FILE, "r") as f:
-                                payload = f.read().strip()
-                        else:
-                            payload = ""
-                        send_request(target["ip_address"], target["auth_id"], "ADDLIST", auth_key, payload)
-                    elif req_command == "list":
-                        send_request(target["ip_address"], target["auth_id"], "LIST", auth_key)
-                    else:
-                        send_request(target["ip_address"], target["auth_id"], req_command, auth_key)
-                else:
+                result, lines = client.call("request", identifier=parts[1], command=parts[2])
+                if result is None:
                     print("Kontakt nicht gefunden.")
+                print_log(lines)
             else:
                 print("Unbekannter Befehl. Tippe 'Help' für Befehle.")
-        except KeyboardInterrupt:
+        except (KeyboardInterrupt, EOFError):
             print("Beende kws-service.")
             break
+        except (OSError, kws_control.ControlError) as e:
+            print("Fehler:", e)
+            if isinstance(client, kws_control.SocketClient) and isinstance(e, OSError):
+                # kws.py wurde beendet: ab jetzt ohne Steuer-Socket weiter
+                client.close()
+                client = open_client()
         except Exception as e:
             print("Fehler:", e)
+    client.close()
 
 if __name__ == "__main__":
     main()
@@ -2,30 +2,146 @@
 """
 kws.py – Hauptserver
 - Legt alle erforderlichen Dateien an (auth.key, config.cfk, contaktd.cdf, datatrans.ksys, data.ksys), falls sie noch nicht existieren.
-- Lädt Kontakte aus der Datei contaktd.cdf.
-- Startet einen TCP-Server (Port 5000), der eingehende Nachrichten (PING, MSG, REQ) verarbeitet.
-- Verarbeitet erweiterte REQ-Befehle: INFO, ADDLIST, LIST.
+- Lädt Kontakte einmalig aus der Datei contaktd.cdf in den Kontaktspeicher (kws_contacts.py);
+  ein binäres Kontaktbuch contaktd.cdb (kws-convert.py) wird stattdessen per mmap eingeblendet.
+- Startet einen TCP-Server (Port 5000, abweichend über KWS_PORT), der eingehende Nachrichten (PING, MSG, REQ) verarbeitet.
+  Wahlweise ein Thread pro Verbindung (server_mode=thread) oder ein asyncio-Event-Loop
+  (server_mode=asyncio) mit konfigurierbarem Backlog, Verbindungslimit und Lese-Timeout.
+- Spricht neben dem alten Einmal-Format das gerahmte Protokoll aus kws_proto.py
+  (dauerhafte Verbindungen, gepipelinte Frames, keine 4-KB-Grenze).
+- Mit workers > 1 (config.cfk) lauschen zusätzliche Prozesse per SO_REUSEPORT auf demselben
+  Port (kws_workers.py); Kontaktänderungen, Log und Posteingang schreibt nur der Hauptprozess,
+  der auch doppelte Nachrichten-IDs für alle Prozesse erkennt.
+- Zulassungskontrolle (kws_limits.py): Token-Buckets je Quell-IP und je auth_id, getrennt für
+  günstige (PING, MSG, INFO, ...) und teure Befehle (ADDLIST, LIST, SYNC, GOSSIP, RELAY,
+  STATS), dazu ein Limit gleichzeitiger Verbindungen je Quell-IP. Über dem Budget lautet die
+  Antwort "BUSY"; abgewiesene Anfragen zählt STATS unter rejected.*. Die Budgets gelten je
+  Server-Prozess (bei workers > 1 also entsprechend vervielfacht).
+- "python3 kws.py --profile": misst Abschnitte des Anfragepfads (recv, Anfrage, Parsen,
+  Laden/Zusammenführen/Speichern der Kontakte, Log), profiliert jede profile_sample-te Anfrage
+  mit cProfile, verfolgt den Speicher mit tracemalloc und hängt alle profile_interval Sekunden
+  einen Bericht an profile.txt an (kws_profile.py). Ohne --profile kostet das praktisch nichts.
+- Verarbeitet erweiterte REQ-Befehle: INFO, ADDLIST, LIST, SYNC (Delta-Abgleich über Digests),
+  STATS (Zähler, aktive Verbindungen, Bytes, Warteschlangentiefe, Latenz-Histogramme; kws_stats.py).
 - Startet einen Hintergrund-Thread, der periodisch alle Kontakte anpingt und deren Status aktualisiert.
-- Loggt empfangene Nachrichten in datatrans.ksys (temporär) und in data.ksys (dauerhaft) für nicht abgeschickte Nachrichten.
+  Die Pings laufen parallel (ping_concurrency) mit einer Gesamtfrist (ping_deadline) pro Runde.
+  Kürzlich aktive Kontakte werden übersprungen, offline Kontakte mit wachsendem Abstand
+  (exponentielles Backoff bis ping_max_backoff) erneut versucht.
+  Gepingt wird zuerst per UDP-Heartbeat (udp_heartbeat); nur Gegenstellen ohne UDP-Antwort,
+  die den Heartbeat noch nie beantwortet haben, werden zusätzlich per TCP angepingt.
+- Gossip: alle gossip_interval Sekunden tauscht kws.py die zuletzt geänderten Kontakte
+  (neu oder neue Version) mit gossip_fanout zufälligen online Kontakten aus (REQ GOSSIP,
+  Push und Pull); jede Änderung wird gossip_rounds Runden lang weitergegeben. Gepushte
+  Kontakte werden nur von bekannten Absendern übernommen.
+- Nachrichten-IDs ("MSG#<id>;..."): bereits gesehene IDs (dedup_ttl Sekunden, höchstens
+  dedup_max) werden nicht erneut verarbeitet, sondern mit der gemerkten Antwort beantwortet;
+  trifft eine Wiederholung ein, während das Original noch verarbeitet wird, lautet sie "BUSY".
+- BATCH: nimmt viele MSG in einem Frame an und bestätigt sie mit einer Liste von IDs.
+- RELAY: leitet eine MSG an einen Kontakt weiter, der den Absender nicht direkt erreicht
+  (direkt, über ein weiteres Relay bis relay_hops oder über die eigene Ausgangswarteschlange).
+- Steuer-Socket (kws.sock im Datenordner, kws_control.py): kws-service.py schickt Kontakt-
+  abfragen, Add, Message, Request, Stats und Show an den laufenden kws.py, der sie mit
+  seinem Kontaktspeicher, Verbindungspool, dem Posteingang und den letzten log_tail_lines
+  Log-Zeilen beantwortet.
+- Ein UDP-Listener auf demselben Port beantwortet PING-Datagramme bekannter Kontakte mit PONG.
+- Jede eingehende PING/MSG/REQ-Nachricht eines Kontakts setzt ihn auf online (last_contact).
+- Kontaktänderungen landen im Journal contaktd.jrn; ein Hintergrund-Thread übernimmt sie
+  periodisch in contaktd.cdf (compact_interval, journal_max_bytes).
+- Empfangene MSG landen zusätzlich im Posteingang inbox.msg mit Index inbox.idx (kws_inbox.py).
+- Loggt empfangene Nachrichten gepuffert über einen Hintergrund-Thread (kws_log.py) in
+  datatrans.ksys (temporär), mit Rotation nach Größe/Alter. Nicht abgeschickte Nachrichten verwalten
+  kws-client.py und kws-service.py in der Ausgangswarteschlange outbox/ (kws_queue.py).
 """
 
+import argparse
+import asyncio
+import collections
+import json
 import os
+import random
 import socket
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime
 import uuid
 
+import kws_contacts
+import kws_control
+import kws_inbox
+import kws_limits
+import kws_profile
+import kws_proto
+import kws_relay
+import kws_workers
+from kws_contacts import TIME_FORMAT, ContactStore, format_contacts, parse_contacts_from_string
+from kws_log import LogWriter
+from kws_queue import Outbox
+from kws_stats import stats
+
 # Dateipfade (alle im selben Ordner wie das Script)
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
-AUTH_KEY_FILE = os.path.join(SCRIPT_DIR, "auth.key")
-CONFIG_FILE = os.path.join(SCRIPT_DIR, "config.cfk")
-CONTACT_FILE = os.path.join(SCRIPT_DIR, "contaktd.cdf")
-DATATRANS_FILE = os.path.join(SCRIPT_DIR, "datatrans.ksys")
-DATA_FILE = os.path.join(SCRIPT_DIR, "data.ksys")  # dauerhafte Speicherung unsent messages
+# KWS_DATA_DIR erlaubt einen eigenen Datenordner, z. B. für mehrere Knoten auf einem Rechner
+DATA_DIR = os.environ.get("KWS_DATA_DIR", SCRIPT_DIR)
+AUTH_KEY_FILE = os.path.join(DATA_DIR, "auth.key")
+CONFIG_FILE = os.path.join(DATA_DIR, "config.cfk")
+CONTACT_FILE = kws_contacts.contact_file(DATA_DIR)  # contaktd.cdb, falls umgewandelt, sonst contaktd.cdf
+DATATRANS_FILE = os.path.join(DATA_DIR, "datatrans.ksys")
+DATA_FILE = os.path.join(DATA_DIR, "data.ksys")  # dauerhafte Speicherung unsent messages
+OUTBOX_DIR = os.path.join(DATA_DIR, "outbox")  # Ausgangswarteschlange von kws-client.py/kws-service.py
+ROUTES_FILE = os.path.join(DATA_DIR, "routes.json")  # Routen-Cache für RELAY (kws_relay.py)
+CONTROL_SOCKET = kws_control.socket_path(DATA_DIR)  # Steuer-Socket für kws-service.py
+PROFILE_FILE = os.path.join(DATA_DIR, "profile.txt")  # Berichte von --profile
 
-SERVER_PORT = 5000
+SERVER_PORT = int(os.environ.get("KWS_PORT", kws_proto.DEFAULT_PORT))  # eigener Port; Kontakte ohne ":port" nutzen 5000
 PING_INTERVAL = 30  # Standard-Pingintervall (in Sekunden)
+SERVER_MODE = "thread"  # "thread" (ein Thread pro Verbindung) oder "asyncio"
+SERVER_BACKLOG = 128  # Länge der Accept-Warteschlange
+WORKERS = 1  # Server-Prozesse, die sich den Port teilen (SO_REUSEPORT)
+MAX_CONNECTIONS = 1000  # max. gleichzeitige Verbindungen im asyncio-Modus
+READ_TIMEOUT = 10  # Lese-Timeout pro Verbindung (in Sekunden)
+IDLE_TIMEOUT = 120  # gerahmte Verbindungen so lange ohne Frame offen halten (in Sekunden)
+PING_TIMEOUT = 5  # Timeout pro Ping (in Sekunden)
+PING_CONCURRENCY = 64  # max. gleichzeitige Pings pro Runde
+PING_DEADLINE = 10  # Gesamtfrist einer Ping-Runde (in Sekunden)
+PING_MAX_BACKOFF = 3600  # längster Abstand zwischen Pings an einen offline Kontakt (in Sekunden)
+LIVENESS_REFRESH = 60  # last_contact eines aktiven Kontakts höchstens so oft schreiben (in Sekunden)
+COMPACT_INTERVAL = 300  # spätestens so oft wird das Kontakt-Journal kompaktiert (in Sekunden)
+JOURNAL_MAX_BYTES = 1024 * 1024  # ab dieser Journalgröße sofort kompaktieren
+UDP_HEARTBEAT = True  # UDP-Heartbeat anbieten und für Pings verwenden
+HEARTBEAT_TIMEOUT = 1  # Frist für UDP-Antworten einer Ping-Runde (in Sekunden)
+GOSSIP_INTERVAL = 30  # Abstand der Gossip-Runden (in Sekunden, 0 = aus)
+GOSSIP_FANOUT = 3  # Gegenstellen pro Gossip-Runde
+GOSSIP_ROUNDS = 4  # so viele Runden wird eine Änderung weitergegeben
+GOSSIP_MAX_ENTRIES = 500  # max. Kontakte pro Gossip-Nachricht
+RELAY_HOPS = 2  # max. Relay-Stationen einer weitergeleiteten MSG
+DEDUP_TTL = 600  # so lange werden gesehene Nachrichten-IDs gemerkt (in Sekunden)
+DEDUP_MAX = 100000  # max. gemerkte Nachrichten-IDs
+RATE_LIMIT = True  # Zulassungskontrolle für eingehende Anfragen (Budgets je Server-Prozess)
+RATE_CHEAP = 50  # günstige Anfragen pro Sekunde je Quell-IP bzw. auth_id
+BURST_CHEAP = 200  # so viele günstige Anfragen dürfen auf einmal kommen
+RATE_EXPENSIVE = 1  # teure Anfragen pro Sekunde je Quell-IP bzw. auth_id
+BURST_EXPENSIVE = 10
+MAX_CONNECTIONS_PER_SOURCE = 64  # gleichzeitige Verbindungen je Quell-IP (0 = unbegrenzt)
+EXPENSIVE_REQUESTS = {"REQ:ADDLIST", "REQ:LIST", "REQ:SYNC", "REQ:GOSSIP", "REQ:RELAY", "REQ:STATS"}
+PROFILE_INTERVAL = 60  # Abstand der Profiling-Berichte (in Sekunden)
+PROFILE_SAMPLE = 100  # jede n-te Anfrage läuft unter cProfile
+PROFILE_MEMORY = True  # tracemalloc im Profiling-Modus
+CONTROL = True  # Steuer-Socket für kws-service.py anbieten
+LOG_TAIL_LINES = 1000  # so viele Log-Zeilen hält kws.py für "Show --log" im Speicher
+DEDUP_MAX_REPLY = 4096  # größere Antworten (z. B. LIST) werden nicht gemerkt, sondern neu erzeugt
+
+routes = kws_relay.RouteCache(ROUTES_FILE)
+contact_store = None  # ContactStore, wird in main() angelegt
+# Gepufferter Log-Schreiber für datatrans.ksys; Rotation wird in main() konfiguriert
+log_writer = LogWriter(DATATRANS_FILE)
+log_tail = collections.deque(maxlen=LOG_TAIL_LINES)  # letzte Zeilen von datatrans.ksys für den Steuer-Socket
+inbox = kws_inbox.Inbox(DATA_DIR)  # empfangene MSG mit Index für "Show"
+
+# Token-Buckets (je Quell-IP, je auth_id); werden in main() nach config.cfk neu angelegt
+cheap_limits = (kws_limits.TokenBuckets(RATE_CHEAP, BURST_CHEAP), kws_limits.TokenBuckets(RATE_CHEAP, BURST_CHEAP))
+expensive_limits = (kws_limits.TokenBuckets(RATE_EXPENSIVE, BURST_EXPENSIVE), kws_limits.TokenBuckets(RATE_EXPENSIVE, BURST_EXPENSIVE))
+connection_limit = kws_limits.ConnectionLimit(MAX_CONNECTIONS_PER_SOURCE)
 
 def create_required_files():
     # auth.key
@@ -69,193 +185,738 @@ def load_config():
                     config[k] = v
     return config
 
-def load_contacts():
-    contacts = []
-    if os.path.exists(CONTACT_FILE):
-        with open(CONTACT_FILE, "r") as f:
-            for line in f:
-                line = line.strip()
-                if line:
-                    if line.endswith("|"):
-                        line = line[:-1]
-                    parts = line.split(";")
-                    if len(parts) >= 6:
-                        contact = {
-                            "username": parts[0],
-                            "auth_id": parts[1],
-                            "last_contact": parts[2],
-                            "user_defined_name": parts[3],
-                            "ip_address": parts[4],
-                            "status": parts[5]
-                        }
-                        contacts.append(contact)
-    return contacts
-
-def save_contacts(contacts):
-    with open(CONTACT_FILE, "w") as f:
-        for c in contacts:
-            line = f"{c['username']};{c['auth_id']};{c['last_contact']};{c['user_defined_name']};{c['ip_address']};{c['status']}|"
-            f.write(line + "\n")
-
 def log_message(message):
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    with open(DATATRANS_FILE, "a") as f:
-        f.write(f"[{timestamp}] {message}\n")
+    with kws_profile.span("log"):
+        log_writer.write(message)
+        log_tail.append(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {message}")
+
+def load_log_tail():
+    # Beim Start die letzten Zeilen von datatrans.ksys übernehmen
+    if os.path.exists(DATATRANS_FILE):
+        with open(DATATRANS_FILE, "r") as f:
+            log_tail.extend(line.rstrip("\n") for line in f)
+
+def recent_log(limit=0):
+    lines = list(log_tail)
+    return lines[-limit:] if limit else lines
+
+def format_stats():
+    # Zustandswerte auffrischen, die nur bei Abfrage gemessen werden, dann formatieren
+    stats.set("outbox.depth", Outbox(OUTBOX_DIR).depth())
+    stats.set("contacts", len(contact_store))
+    return stats.format()
+
+def control_loop(auth_key):
+    commands = kws_control.Commands(auth_key, contact_store, Outbox(OUTBOX_DIR), routes, log_message,
+                                    format_stats, recent_log, inbox, RELAY_HOPS)
+    try:
+        kws_control.serve(CONTROL_SOCKET, commands)
+    except OSError as e:
+        print("Steuer-Socket nicht verfügbar:", e)
 
 def log_permanent(message):
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     with open(DATA_FILE, "a") as f:
         f.write(f"[{timestamp}] {message}\n")
 
-def parse_contacts_from_string(data):
-    contacts = []
-    lines = data.strip().splitlines()
-    for line in lines:
-        line = line.strip()
-        if line:
-            if line.endswith("|"):
-                line = line[:-1]
-            parts = line.split(";")
-            if len(parts) >= 6:
-                contact = {
-                    "username": parts[0],
-                    "auth_id": parts[1],
-                    "last_contact": parts[2],
-                    "user_defined_name": parts[3],
-                    "ip_address": parts[4],
-                    "status": parts[5]
-                }
-                contacts.append(contact)
-    return contacts
-
-def merge_contacts(existing, new):
-    for new_contact in new:
-        found = False
-        for contact in existing:
-            if contact["auth_id"] == new_contact["auth_id"]:
-                found = True
-                # Bei neueren Kontaktdaten aktualisieren (optional)
-                if new_contact["last_contact"] > contact["last_contact"]:
-                    contact["last_contact"] = new_contact["last_contact"]
-                break
-        if not found:
-            existing.append(new_contact)
-    return existing
+# Zuletzt gesehene Nachrichten-IDs: id -> (Zeitpunkt, Antwort), älteste zuerst; Antwort
+# None = wird gerade verarbeitet
+seen_ids = collections.OrderedDict()
+seen_lock = threading.Lock()
+dedup_client = None  # im Worker: kws_workers.DedupClient, gemerkt wird im Hauptprozess
+
+def prune_seen_ids(now):
+    while seen_ids:
+        oldest = next(iter(seen_ids.values()))
+        if len(seen_ids) <= DEDUP_MAX and now - oldest[0] < DEDUP_TTL:
+            break
+        seen_ids.popitem(last=False)
+
+def claim_id(msg_id):
+    # In einem Schritt prüfen und reservieren: liefert die gemerkte Antwort, "BUSY", solange
+    # die erste Zustellung noch verarbeitet wird, oder None (ID jetzt reserviert)
+    if dedup_client is not None:
+        return dedup_client.claim(msg_id)
+    now = time.time()
+    with seen_lock:
+        entry = seen_ids.get(msg_id)
+        if entry and now - entry[0] < DEDUP_TTL:
+            return "BUSY" if entry[1] is None else entry[1]
+        seen_ids[msg_id] = (now, None)
+        seen_ids.move_to_end(msg_id)
+        prune_seen_ids(now)
+    return None
+
+def remember_id(msg_id, reply):
+    # Antwort zur reservierten ID merken; ohne (merkbare) Antwort wird die Reservierung
+    # freigegeben und eine Wiederholung erneut verarbeitet
+    if reply is not None and len(reply) > DEDUP_MAX_REPLY:
+        reply = None
+    if dedup_client is not None:
+        dedup_client.remember(msg_id, reply)
+        return
+    now = time.time()
+    with seen_lock:
+        if reply is None:
+            seen_ids.pop(msg_id, None)
+            return
+        seen_ids[msg_id] = (now, reply)
+        seen_ids.move_to_end(msg_id)
+        prune_seen_ids(now)
+
+def process_request(data, addr, auth_key):
+    # Duplikate (gleiche Nachrichten-ID) erhalten die gemerkte Antwort, ohne erneut
+    # verarbeitet oder geloggt zu werden
+    data, msg_id = kws_proto.split_id(data)
+    if msg_id is None:
+        return execute_request(data, addr, auth_key)
+    reply = claim_id(msg_id)
+    if reply is not None:
+        stats.incr("dedup.pending" if reply == "BUSY" else "dedup.dropped")
+        return reply
+    try:
+        reply = execute_request(data, addr, auth_key)
+    finally:
+        remember_id(msg_id, reply)
+    return reply
+
+def execute_request(data, addr, auth_key):
+    # Gemeinsame Befehlslogik für alle Servermodi; liefert die Antwort (oder None)
+    parts = data.split(";")
+    if parts[0] in ("PING", "MSG", "REQ") and len(parts) > 1:
+        # Jeder eingehende Austausch belegt, dass der Absender erreichbar ist
+        contact_store.touch(parts[1], LIVENESS_REFRESH)
+    if parts[0] == "PING":
+        sender_auth = parts[1] if len(parts) > 1 else "unknown"
+        print(f"PING von {addr} (Auth: {sender_auth})")
+        log_message(f"PING von {addr} (Auth: {sender_auth})")
+        return "PONG"
+    elif parts[0] == "MSG":
+        if len(parts) >= 4:
+            sender_auth = parts[1]
+            msg_time = parts[2]
+            message_content = ";".join(parts[3:])
+            print(f"MSG von {addr} (Auth: {sender_auth}): {message_content}")
+            log_message(f"MSG von {sender_auth}: {message_content} (um {msg_time})")
+            inbox.append(sender_auth, msg_time, message_content)
+            return "MSG_RECEIVED"
+        return None
+    elif parts[0] == "BATCH":
+        # "BATCH;<auth>;<JSON [[id, MSG], ...]>" -> "BATCH_RECEIVED;<angenommene IDs>"
+        try:
+            entries = json.loads(data.split(";", 2)[2])
+        except (IndexError, ValueError):
+            return "INVALID_BATCH"
+        # Höchstens BATCH_MAX Nachrichten, sonst kostete ein riesiger Frame nur eine Marke
+        if not isinstance(entries, list) or len(entries) > kws_proto.BATCH_MAX:
+            return "INVALID_BATCH"
+        accepted = []
+        for entry in entries:
+            if (isinstance(entry, list) and len(entry) == 2 and kws_proto.is_msg(str(entry[1]))
+                    and process_request(entry[1], addr, auth_key) == "MSG_RECEIVED"):
+                accepted.append(str(entry[0]))
+        stats.incr("batch.messages", len(accepted))
+        return "BATCH_RECEIVED;" + ",".join(accepted)
+    elif parts[0] == "REQ":
+        if len(parts) >= 4:
+            sender_auth = parts[1]
+            target_auth = parts[2]
+            command = parts[3].upper()
+            payload = ""
+            if len(parts) > 4:
+                payload = ";".join(parts[4:])
+            if target_auth != auth_key:
+                log_message(f"REQ von {addr} für falsches Ziel: {target_auth} (meine Auth: {auth_key})")
+                return "WRONG_TARGET"
+            if command == "INFO":
+                log_message(f"INFO-Anfrage von {addr} beantwortet.")
+                return f"INFO;{auth_key}"
+            elif command == "ADDLIST":
+                # Erwartet: payload enthält die übertragene Kontaktliste
+                if payload:
+                    contacts = parse_contacts_from_string(payload)
+                    contact_store.merge(contacts)
+                    routes.learn(sender_auth, contacts)
+                    log_message(f"ADDLIST von {addr} verarbeitet, Kontakte aktualisiert.")
+                    return "ADDLIST_RECEIVED"
+                return "NO_PAYLOAD"
+            elif command == "SYNC":
+                # Payload: <n>;<hash0>,<hash1>,...  -> Antwort: abweichende Buckets + unsere Kontakte darin
+                try:
+                    n_str, hashes = payload.split(";", 1)
+                    n = int(n_str)
+                    theirs = hashes.split(",")
+                except ValueError:
+                    return "INVALID_SYNC"
+                if not 1 <= n <= kws_contacts.MAX_BUCKETS or len(theirs) != n:
+                    return "INVALID_SYNC"
+                diff = kws_contacts.diff_buckets(contact_store.digest(n), theirs)
+                contacts = contact_store.in_buckets(diff, n)
+                log_message(f"SYNC von {addr}: {len(diff)} von {n} Buckets abweichend, {len(contacts)} Kontakte gesendet.")
+                return f"SYNC;{','.join(map(str, diff))};{format_contacts(contacts).strip()}"
+            elif command == "GOSSIP":
+                # Push: übernehmen, was neuer ist – nur von bekannten Kontakten, sonst könnte ein
+                # Unbekannter mit hoher Version Adressen überschreiben; Pull: eigene letzte Änderungen zurück
+                received = 0
+                if payload and contact_store.get(sender_auth) is None:
+                    stats.incr("gossip.denied")
+                    log_message(f"GOSSIP von unbekanntem Absender {sender_auth} ({addr}) nicht übernommen.")
+                elif payload:
+                    received = contact_store.merge(parse_contacts_from_string(payload))
+                    stats.incr("gossip.received", received)
+                    log_message(f"GOSSIP von {addr}: {received} Kontakte übernommen.")
+                return f"GOSSIP;{format_contacts(gossip_entries()).strip()}"
+            elif command == "RELAY":
+                # Payload: <ziel-auth>;<hops>;MSG;...
+                try:
+                    relay_target, hops, inner = payload.split(";", 2)
+                    hops = int(hops)
+                except ValueError:
+                    return "INVALID_RELAY"
+                if not kws_proto.is_msg(inner):
+                    return "INVALID_RELAY"
+                if contact_store.get(sender_auth) is None:
+                    return "RELAY_DENIED"  # kein offenes Relay für Unbekannte
+                return relay_message(relay_target, min(hops, RELAY_HOPS), inner, sender_auth, addr, auth_key)
+            elif command == "STATS":
+                log_message(f"STATS-Anfrage von {addr} beantwortet.")
+                return f"STATS;{format_stats()}"
+            elif command == "LIST":
+                contacts_data = contact_store.serialize()
+                log_message(f"LIST-Anfrage von {addr} beantwortet.")
+                return f"LIST;{contacts_data}"
+            return "UNBEKANNT_COMMAND"
+        return "INVALID_REQ_FORMAT"
+    return "UNKNOWN_COMMAND"
+
+def relay_message(target_auth, hops, message, sender_auth, addr, auth_key):
+    if target_auth == auth_key:
+        process_request(message, addr, auth_key)
+        return "RELAYED"
+    contact = contact_store.get(target_auth)
+    if contact is None:
+        return "RELAY_UNKNOWN"
+    ip = contact["ip_address"]
+    try:
+        host, port = kws_proto.split_address(ip)
+        if kws_proto.exchange(host, port, message, timeout=PING_TIMEOUT) == "MSG_RECEIVED":
+            stats.incr("relay.delivered")
+            log_message(f"MSG von {sender_auth} an {ip} weitergeleitet.")
+            return "RELAYED"
+    except Exception:
+        pass
+    if hops > 1:
+        relay, reply = kws_relay.send_via_relays(routes, contact_store, target_auth, message, auth_key, hops - 1,
+                                                 exclude={sender_auth}, timeout=PING_TIMEOUT)
+        if relay:
+            stats.incr("relay.forwarded")
+            return reply
+    # Store-and-forward: kws-client.py stellt aus der Ausgangswarteschlange zu
+    Outbox(OUTBOX_DIR).enqueue(ip, message)
+    stats.incr("relay.queued")
+    log_message(f"MSG von {sender_auth} an {ip} zur Weiterleitung in Warteschlange gestellt.")
+    return "RELAY_QUEUED"
+
+def request_kind(data):
+    # Befehlsname für die Statistik, bei REQ inkl. Unterbefehl (z. B. "REQ:LIST")
+    parts = kws_proto.strip_id(data).split(";", 4)
+    if parts[0] == "REQ" and len(parts) >= 4:
+        return "REQ:" + parts[3].upper()
+    return parts[0] if parts[0] in ("PING", "MSG", "REQ", "BATCH") else "UNKNOWN"
+
+def source_of(addr):
+    return addr[0] if isinstance(addr, tuple) else str(addr)
+
+def admit(kind, data, addr):
+    # Je ein Eimer für die Quell-IP und die angegebene auth_id; teure Befehle haben ein
+    # eigenes, kleineres Budget, damit sie günstige Anfragen nicht verdrängen
+    expensive = kind in EXPENSIVE_REQUESTS
+    by_source, by_auth = expensive_limits if expensive else cheap_limits
+    parts = kws_proto.strip_id(data).split(";", 2)
+    sender_auth = parts[1] if len(parts) > 1 and kind != "UNKNOWN" else None
+    if by_source.allow(source_of(addr)) and (not sender_auth or by_auth.allow(sender_auth)):
+        return True
+    stats.incr("rejected.expensive" if expensive else "rejected.cheap")
+    return False
+
+def handle_request(data, addr, auth_key):
+    # process_request mit Zulassungskontrolle, Zählern, Bytes und Latenz-Histogramm
+    kind = request_kind(data)
+    if not admit(kind, data, addr):
+        return "BUSY"
+    start = time.perf_counter()
+    with kws_profile.span("request"):
+        response = kws_profile.sample(process_request, data, addr, auth_key)
+    elapsed = time.perf_counter() - start
+    stats.incr(f"requests.{kind}")
+    stats.incr("bytes.in", len(data))
+    if response:
+        stats.incr("bytes.out", len(response))
+    stats.observe("latency.all", elapsed)
+    stats.observe(f"latency.{kind}", elapsed)
+    return response
 
 def handle_client_connection(conn, addr, auth_key):
+    # Der Platz in connection_limit wurde bereits in server_loop belegt
+    stats.incr("connections.total")
+    stats.incr("connections.active")
     try:
-        data = conn.recv(4096).decode("utf-8")
-        if not data:
+        conn.settimeout(READ_TIMEOUT)
+        with kws_profile.span("recv"):
+            raw = conn.recv(4096)
+            while raw and kws_proto.is_magic_prefix(raw):
+                chunk = conn.recv(4096)
+                if not chunk:
+                    break
+                raw += chunk
+        if not raw:
             return
-        parts = data.split(";")
-        if parts[0] == "PING":
-            sender_auth = parts[1] if len(parts) > 1 else "unknown"
-            print(f"PING von {addr} (Auth: {sender_auth})")
-            conn.sendall("PONG".encode("utf-8"))
-            log_message(f"PING von {addr} (Auth: {sender_auth})")
-        elif parts[0] == "MSG":
-            if len(parts) >= 4:
-                sender_auth = parts[1]
-                msg_time = parts[2]
-                message_content = ";".join(parts[3:])
-                print(f"MSG von {addr} (Auth: {sender_auth}): {message_content}")
-                log_message(f"MSG von {sender_auth}: {message_content} (um {msg_time})")
-                conn.sendall("MSG_RECEIVED".encode("utf-8"))
-        elif parts[0] == "REQ":
-            if len(parts) >= 4:
-                sender_auth = parts[1]
-                target_auth = parts[2]
-                command = parts[3].upper()
-                payload = ""
-                if len(parts) > 4:
-                    payload = ";".join(parts[4:])
-                if target_auth != auth_key:
-                    conn.sendall("WRONG_TARGET".encode("utf-8"))
-                    log_message(f"REQ von {addr} für falsches Ziel: {target_auth} (meine Auth: {auth_key})")
-                else:
-                    if command == "INFO":
-                        response = f"INFO;{auth_key}"
-                        conn.sendall(response.encode("utf-8"))
-                        log_message(f"INFO-Anfrage von {addr} beantwortet.")
-                    elif command == "ADDLIST":
-                        # Erwartet: payload enthält die übertragene Kontaktliste
-                        if payload:
-                            new_contacts = parse_contacts_from_string(payload)
-                            existing_contacts = load_contacts()
-                            merged = merge_contacts(existing_contacts, new_contacts)
-                            save_contacts(merged)
-                            conn.sendall("ADDLIST_RECEIVED".encode("utf-8"))
-                            log_message(f"ADDLIST von {addr} verarbeitet, Kontakte aktualisiert.")
-                        else:
-                            conn.sendall("NO_PAYLOAD".encode("utf-8"))
-                    elif command == "LIST":
-                        with open(CONTACT_FILE, "r") as f:
-                            contacts_data = f.read().strip()
-                        response = f"LIST;{contacts_data}"
-                        conn.sendall(response.encode("utf-8"))
-                        log_message(f"LIST-Anfrage von {addr} beantwortet.")
-                    else:
-                        conn.sendall("UNBEKANNT_COMMAND".encode("utf-8"))
-            else:
-                conn.sendall("INVALID_REQ_FORMAT".encode("utf-8"))
-        else:
-            conn.sendall("UNKNOWN_COMMAND".encode("utf-8"))
+        if raw.startswith(kws_proto.MAGIC):
+            handle_framed_connection(conn, addr, auth_key, raw[len(kws_proto.MAGIC):])
+            return
+        data = raw.decode("utf-8")
+        response = handle_request(data, addr, auth_key)
+        if response is not None:
+            conn.sendall(response.encode("utf-8"))
     except Exception as e:
         print("Fehler bei der Verbindung:", e)
     finally:
+        stats.incr("connections.active", -1)
+        connection_limit.release(source_of(addr))
         conn.close()
 
+def recv_span():
+    # Lesen eines Frames (ab vollständigem Kopf) als Profiling-Abschnitt "recv"
+    return kws_profile.span("recv")
+
+def handle_framed_connection(conn, addr, auth_key, leftover):
+    # Dauerhafte Verbindung: Frames werden der Reihe nach beantwortet, bis der
+    # Client schließt oder READ_TIMEOUT lang nichts mehr kommt.
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    conn.sendall(kws_proto.MAGIC)
+    reader = kws_proto.FrameReader(conn, leftover, timed=recv_span)
+    conn.settimeout(IDLE_TIMEOUT)
+    while True:
+        try:
+            data = reader.read_frame()
+        except socket.timeout:
+            break
+        if data is None:
+            break
+        response = handle_request(data, addr, auth_key)
+        conn.sendall(kws_proto.encode_frame(response or ""))
+
 def server_loop(auth_key):
+    if SERVER_MODE == "asyncio":
+        asyncio.run(async_server_loop(auth_key))
+        return
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if WORKERS > 1:
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     server_socket.bind(("", SERVER_PORT))
-    server_socket.listen(5)
+    server_socket.listen(SERVER_BACKLOG)
     print(f"kws.py: Server läuft auf Port {SERVER_PORT}.")
     while True:
         conn, addr = server_socket.accept()
+        if not connection_limit.acquire(source_of(addr)):
+            # Zu viele gleichzeitige Verbindungen von dieser Adresse: abweisen, ohne einen Thread zu starten
+            stats.incr("rejected.connections")
+            try:
+                conn.sendall(b"BUSY")
+            except OSError:
+                pass
+            conn.close()
+            continue
         threading.Thread(target=handle_client_connection, args=(conn, addr, auth_key), daemon=True).start()
 
+# --- asyncio-Servermodus (server_mode=asyncio in config.cfk) ---
+
+async def async_handle_client(reader, writer, auth_key):
+    addr = writer.get_extra_info("peername")
+    per_source = connection_limit.acquire(source_of(addr))
+    if not per_source or stats.get("connections.active") >= MAX_CONNECTIONS:
+        if per_source:
+            connection_limit.release(source_of(addr))
+        stats.incr("connections.rejected" if per_source else "rejected.connections")
+        # Verbindungslimit erreicht: sofort abweisen statt Ressourcen zu binden
+        try:
+            writer.write("BUSY".encode("utf-8"))
+            await writer.drain()
+        except Exception:
+            pass
+        writer.close()
+        return
+    stats.incr("connections.total")
+    stats.incr("connections.active")
+    try:
+        with kws_profile.span("recv"):
+            raw = await asyncio.wait_for(reader.read(4096), READ_TIMEOUT)
+            while raw and kws_proto.is_magic_prefix(raw):
+                chunk = await asyncio.wait_for(reader.read(4096), READ_TIMEOUT)
+                if not chunk:
+                    break
+                raw += chunk
+        if not raw:
+            return
+        if raw.startswith(kws_proto.MAGIC):
+            await async_handle_framed(reader, writer, addr, auth_key, raw[len(kws_proto.MAGIC):])
+            return
+        response = await async_process_request(raw.decode("utf-8"), addr, auth_key)
+        if response is not None:
+            writer.write(response.encode("utf-8"))
+            await writer.drain()
+    except asyncio.TimeoutError:
+        print(f"Zeitüberschreitung beim Lesen von {addr}.")
+    except Exception as e:
+        print("Fehler bei der Verbindung:", e)
+    finally:
+        stats.incr("connections.active", -1)
+        connection_limit.release(source_of(addr))
+        writer.close()
+
+async def async_process_request(data, addr, auth_key):
+    # Jede Anfrage kann blockieren: MSG/BATCH schreiben in den Posteingang, PING/MSG/REQ
+    # frischen den Kontakt auf (Journal mit fsync), REQ löst Dateizugriffe (ADDLIST/LIST) und
+    # ausgehende Verbindungen (RELAY) aus, im Worker warten Nachrichten-IDs und
+    # Kontaktänderungen auf den Hauptprozess -> nie im Event-Loop ausführen
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, handle_request, data, addr, auth_key)
+
+async def async_handle_framed(reader, writer, addr, auth_key, leftover):
+    sock = writer.get_extra_info("socket")
+    if sock is not None:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    writer.write(kws_proto.MAGIC)
+    await writer.drain()
+    frames = kws_proto.AsyncFrameReader(reader, leftover, timed=recv_span)
+    while True:
+        try:
+            data = await asyncio.wait_for(frames.read_frame(), IDLE_TIMEOUT)
+        except asyncio.TimeoutError:
+            break
+        if data is None:
+            break
+        response = await async_process_request(data, addr, auth_key)
+        writer.write(kws_proto.encode_frame(response or ""))
+        await writer.drain()
+
+async def async_server_loop(auth_key):
+    server = await asyncio.start_server(
+        lambda r, w: async_handle_client(r, w, auth_key),
+        host=None, port=SERVER_PORT, backlog=SERVER_BACKLOG, reuse_address=True, reuse_port=WORKERS > 1 or None)
+    print(f"kws.py: asyncio-Server läuft auf Port {SERVER_PORT} (max. {MAX_CONNECTIONS} Verbindungen).")
+    async with server:
+        await server.serve_forever()
+
+def ping_contact(ip, auth_key):
+    # Über den Verbindungspool: erreichbare Kontakte werden über warme Verbindungen angepingt
+    try:
+        host, port = kws_proto.split_address(ip)
+        return kws_proto.exchange(host, port, f"PING;{auth_key}", timeout=PING_TIMEOUT) == "PONG"
+    except kws_proto.PeerBusy:
+        # Ausgelastet, aber erreichbar: nicht als offline werten und nicht ins Backoff
+        stats.incr("heartbeat.busy")
+        return True
+    except Exception:
+        return False
+
+def heartbeat_reply(data):
+    # Nur Kontakte erhalten ein PONG: "PING;<auth>;<nonce>" -> "PONG;<nonce>"
+    parts = data.split(";")
+    if len(parts) != 3 or parts[0] != "PING" or contact_store.get(parts[1]) is None:
+        stats.incr("heartbeat.rejected")
+        return None
+    if not cheap_limits[1].allow(parts[1]):
+        stats.incr("rejected.heartbeat")
+        return None
+    contact_store.touch(parts[1], LIVENESS_REFRESH)
+    stats.incr("heartbeat.answered")
+    return f"PONG;{parts[2]}"
+
+def heartbeat_loop():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.bind(("", SERVER_PORT))
+    except OSError as e:
+        print("UDP-Heartbeat nicht verfügbar:", e)
+        return
+    print(f"kws.py: UDP-Heartbeat auf Port {SERVER_PORT}.")
+    while True:
+        try:
+            data, addr = sock.recvfrom(kws_proto.UDP_MAX_DATAGRAM)
+            reply = heartbeat_reply(data.decode("utf-8", "replace"))
+            if reply:
+                sock.sendto(reply.encode("utf-8"), addr)
+        except Exception as e:
+            print("Fehler beim UDP-Heartbeat:", e)
+
+# Gegenstellen (Adresse aus contaktd.cdf), die den UDP-Heartbeat schon beantwortet haben
+udp_peers = set()
+
+def udp_probe(contacts, auth_key):
+    # Liefert auth_id -> True/False für alle per UDP entschiedenen Kontakte; die übrigen
+    # (Heartbeat nie beantwortet, evtl. alte Version) müssen per TCP geprüft werden.
+    targets = {c["auth_id"]: kws_proto.split_address(c["ip_address"]) for c in contacts}
+    answered = kws_proto.udp_ping_many(targets, f"PING;{auth_key}", HEARTBEAT_TIMEOUT)
+    results = {}
+    for contact in contacts:
+        ip = contact["ip_address"]
+        if contact["auth_id"] in answered:
+            udp_peers.add(ip)
+            results[contact["auth_id"]] = True
+        elif ip in udp_peers:
+            # Kann UDP, antwortet aber nicht: offline; beim nächsten Mal wieder mit TCP-Rückfall
+            udp_peers.discard(ip)
+            results[contact["auth_id"]] = False
+    stats.incr("heartbeat.udp_online", len(answered))
+    return results
+
+# Ping-Plan je Kontakt: auth_id -> (nächster Ping frühestens, Fehlversuche in Folge)
+probe_schedule = {}
+
+def seconds_since(timestamp):
+    try:
+        return time.time() - datetime.strptime(timestamp, TIME_FORMAT).timestamp()
+    except ValueError:
+        return None
+
+def due_for_probe(contact, now):
+    if contact["status"] == "online":
+        # Kürzlich aktive Kontakte (Ping, MSG oder REQ) nicht erneut anpingen
+        age = seconds_since(contact["last_contact"])
+        return age is None or age >= PING_INTERVAL
+    next_probe, _ = probe_schedule.get(contact["auth_id"], (0, 0))
+    return now >= next_probe
+
+def schedule_probe(auth_id, ok, now):
+    if ok:
+        probe_schedule[auth_id] = (now + PING_INTERVAL, 0)
+        return
+    # Offline: exponentielles Backoff mit Zufallsanteil, damit nicht alle gleichzeitig fällig werden
+    failures = probe_schedule.get(auth_id, (0, 0))[1] + 1
+    delay = min(PING_MAX_BACKOFF, PING_INTERVAL * 2 ** (failures - 1))
+    probe_schedule[auth_id] = (now + delay * random.uniform(0.75, 1.25), failures)
+
+def ping_sweep(auth_key):
+    # Fällige Kontakte parallel anpingen (max. PING_CONCURRENCY gleichzeitig). Pings, die bis
+    # PING_DEADLINE nicht fertig (oder gar nicht gestartet) sind, ändern nichts; diese Kontakte
+    # bleiben fällig und kommen im nächsten Durchlauf dran. Gespeichert wird einmal am Ende.
+    now = time.time()
+    all_contacts = contact_store.all()
+    contacts = [c for c in all_contacts if due_for_probe(c, now)]
+    stats.set("ping_sweep.skipped", len(all_contacts) - len(contacts))
+    if not contacts:
+        return
+    start = time.perf_counter()
+    results = udp_probe(contacts, auth_key) if UDP_HEARTBEAT else {}
+    tcp_contacts = [c for c in contacts if c["auth_id"] not in results]
+    if tcp_contacts:
+        stats.incr("heartbeat.tcp_fallback", len(tcp_contacts))
+        executor = ThreadPoolExecutor(max_workers=min(PING_CONCURRENCY, len(tcp_contacts)))
+        futures = {executor.submit(ping_contact, c["ip_address"], auth_key): c for c in tcp_contacts}
+        done, _ = wait(futures, timeout=max(0, PING_DEADLINE - (time.perf_counter() - start)))
+        executor.shutdown(wait=False, cancel_futures=True)
+        for future in done:
+            results[futures[future]["auth_id"]] = future.result()
+        stats.set("ping_sweep.unfinished", len(futures) - len(done))
+    timestamp = datetime.now().strftime(TIME_FORMAT)
+    updates = {}
+    for contact in contacts:
+        if contact["auth_id"] not in results:
+            continue
+        ip = contact["ip_address"]
+        ok = results[contact["auth_id"]]
+        schedule_probe(contact["auth_id"], ok, now)
+        if ok:
+            updates[contact["auth_id"]] = {"status": "online", "last_contact": timestamp}
+            print(f"{contact['user_defined_name']} ({ip}) ist online.")
+        else:
+            updates[contact["auth_id"]] = {"status": "offline"}
+            print(f"{contact['user_defined_name']} ({ip}) ist offline.")
+    contact_store.update_many(updates)
+    elapsed = time.perf_counter() - start
+    stats.observe("ping_sweep", elapsed)
+    stats.set("ping_sweep.last_seconds", round(elapsed, 3))
+    stats.set("ping_sweep.probed", len(updates))
+    stats.set("ping_sweep.online", sum(1 for u in updates.values() if u["status"] == "online"))
+
+# Änderungsnummer des Kontaktspeichers zu Beginn der letzten GOSSIP_ROUNDS Runden;
+# der älteste Eintrag begrenzt, welche Änderungen noch weitergegeben werden.
+gossip_marks = collections.deque([0], maxlen=GOSSIP_ROUNDS)
+
+def gossip_entries():
+    return contact_store.changes_since(gossip_marks[0])[-GOSSIP_MAX_ENTRIES:]
+
+def gossip_with(peer, entries, auth_key):
+    ip = peer["ip_address"]
+    try:
+        host, port = kws_proto.split_address(ip)
+        request = kws_proto.with_id(f"REQ;{auth_key};{peer['auth_id']};GOSSIP;{format_contacts(entries).strip()}")
+        reply = kws_proto.exchange(host, port, request, timeout=PING_TIMEOUT)
+    except Exception as e:
+        log_message(f"GOSSIP an {ip} fehlgeschlagen: {e}")
+        return
+    if not reply.startswith("GOSSIP;"):
+        return  # ältere Gegenstelle ohne GOSSIP
+    received = contact_store.merge(parse_contacts_from_string(reply[len("GOSSIP;"):]))
+    stats.incr("gossip.received", received)
+
+def gossip_round(auth_key):
+    entries = gossip_entries()
+    gossip_marks.append(contact_store.change_seq)
+    peers = [c for c in contact_store.all() if c["status"] == "online" and c["auth_id"] != auth_key]
+    for peer in random.sample(peers, min(GOSSIP_FANOUT, len(peers))):
+        gossip_with(peer, entries, auth_key)
+    stats.incr("gossip.rounds")
+    stats.incr("gossip.sent", len(entries))
+
+def gossip_contacts(auth_key):
+    while True:
+        time.sleep(GOSSIP_INTERVAL)
+        try:
+            gossip_round(auth_key)
+        except Exception as e:
+            print("Fehler bei der Gossip-Runde:", e)
+
 def ping_contacts(auth_key):
     while True:
-        contacts = load_contacts()
-        updated = False
-        for contact in contacts:
-            ip = contact["ip_address"]
+        ping_sweep(auth_key)
+        kws_proto.pool.close_idle()
+        time.sleep(PING_INTERVAL)
+
+def compact_contacts():
+    # Journal der Kontaktänderungen regelmäßig bzw. ab JOURNAL_MAX_BYTES in den Snapshot übernehmen
+    last_compact = time.time()
+    while True:
+        time.sleep(5)
+        size = contact_store.journal_size()
+        if size == 0:
+            last_compact = time.time()
+            continue
+        if size >= JOURNAL_MAX_BYTES or time.time() - last_compact >= COMPACT_INTERVAL:
             try:
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.settimeout(5)
-                s.connect((ip, SERVER_PORT))
-                s.sendall(f"PING;{auth_key}".encode("utf-8"))
-                reply = s.recv(1024).decode("utf-8")
-                if reply == "PONG":
-                    contact["status"] = "online"
-                    contact["last_contact"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    print(f"{contact['user_defined_name']} ({ip}) ist online.")
-                s.close()
+                contact_store.compact()
             except Exception as e:
-                contact["status"] = "offline"
-                print(f"{contact['user_defined_name']} ({ip}) ist offline.")
-            updated = True
-        if updated:
-            save_contacts(contacts)
-        time.sleep(PING_INTERVAL)
+                print("Fehler bei der Kompaktierung der Kontakte:", e)
+            last_compact = time.time()
+
+def worker_main(auth_key, store_conn, events):
+    # Läuft im Worker-Prozess: nur der TCP-Server. Kontaktänderungen, gesehene
+    # Nachrichten-IDs, Log-Zeilen und Nachrichten gehen an den Hauptprozess (kws_workers.py).
+    global contact_store, log_writer, inbox, dedup_client
+    threading.Thread(target=kws_workers.watch_parent, args=(os.getppid(),), daemon=True).start()
+    contact_store = kws_workers.StoreClient(ContactStore(CONTACT_FILE), store_conn)
+    dedup_client = kws_workers.DedupClient(contact_store, events)
+    log_writer = kws_workers.QueueLog(events)
+    inbox = kws_workers.QueueInbox(events)
+    try:
+        server_loop(auth_key)
+    except KeyboardInterrupt:
+        pass
+
+def config_int(config, key, default):
+    try:
+        return int(config[key])
+    except (KeyError, ValueError):
+        return default
 
 def main():
+    parser = argparse.ArgumentParser(description="KWS-Hauptserver")
+    parser.add_argument("--profile", action="store_true",
+                        help="Profiling-Modus: Abschnittszeiten, gesampeltes cProfile und tracemalloc nach profile.txt")
+    args = parser.parse_args()
     auth_key = create_required_files()
     config = load_config()
-    global PING_INTERVAL
-    if "ping_interval" in config:
+    global contact_store
+    contact_store = ContactStore(CONTACT_FILE)
+    global PING_INTERVAL, SERVER_MODE, SERVER_BACKLOG, MAX_CONNECTIONS, READ_TIMEOUT, IDLE_TIMEOUT
+    global PING_TIMEOUT, PING_CONCURRENCY, PING_DEADLINE, COMPACT_INTERVAL, JOURNAL_MAX_BYTES
+    global PING_MAX_BACKOFF, LIVENESS_REFRESH, UDP_HEARTBEAT, HEARTBEAT_TIMEOUT
+    global GOSSIP_INTERVAL, GOSSIP_FANOUT, GOSSIP_ROUNDS, gossip_marks, RELAY_HOPS, DEDUP_TTL, DEDUP_MAX
+    global CONTROL, LOG_TAIL_LINES, log_tail, WORKERS
+    global RATE_LIMIT, RATE_CHEAP, BURST_CHEAP, RATE_EXPENSIVE, BURST_EXPENSIVE, MAX_CONNECTIONS_PER_SOURCE
+    global cheap_limits, expensive_limits, connection_limit
+    global PROFILE_INTERVAL, PROFILE_SAMPLE, PROFILE_MEMORY
+    PING_INTERVAL = config_int(config, "ping_interval", PING_INTERVAL)
+    SERVER_MODE = config.get("server_mode", SERVER_MODE).strip().lower()
+    SERVER_BACKLOG = config_int(config, "backlog", SERVER_BACKLOG)
+    WORKERS = max(1, config_int(config, "workers", WORKERS))
+    if WORKERS > 1 and not kws_workers.supported():
+        print("workers > 1 wird auf diesem System nicht unterstützt, es läuft ein Prozess.")
+        WORKERS = 1
+    MAX_CONNECTIONS = config_int(config, "max_connections", MAX_CONNECTIONS)
+    READ_TIMEOUT = config_int(config, "read_timeout", READ_TIMEOUT)
+    IDLE_TIMEOUT = config_int(config, "idle_timeout", IDLE_TIMEOUT)
+    PING_TIMEOUT = config_int(config, "ping_timeout", PING_TIMEOUT)
+    PING_CONCURRENCY = max(1, config_int(config, "ping_concurrency", PING_CONCURRENCY))
+    PING_DEADLINE = config_int(config, "ping_deadline", PING_DEADLINE)
+    PING_MAX_BACKOFF = config_int(config, "ping_max_backoff", PING_MAX_BACKOFF)
+    LIVENESS_REFRESH = config_int(config, "liveness_refresh", LIVENESS_REFRESH)
+    UDP_HEARTBEAT = config.get("udp_heartbeat", "on").strip().lower() not in ("off", "0", "no")
+    HEARTBEAT_TIMEOUT = config_int(config, "heartbeat_timeout", HEARTBEAT_TIMEOUT)
+    GOSSIP_INTERVAL = config_int(config, "gossip_interval", GOSSIP_INTERVAL)
+    GOSSIP_FANOUT = config_int(config, "gossip_fanout", GOSSIP_FANOUT)
+    GOSSIP_ROUNDS = max(1, config_int(config, "gossip_rounds", GOSSIP_ROUNDS))
+    gossip_marks = collections.deque([0], maxlen=GOSSIP_ROUNDS)
+    RELAY_HOPS = config_int(config, "relay_hops", RELAY_HOPS)
+    DEDUP_TTL = config_int(config, "dedup_ttl", DEDUP_TTL)
+    DEDUP_MAX = config_int(config, "dedup_max", DEDUP_MAX)
+    RATE_LIMIT = config.get("rate_limit", "on").strip().lower() not in ("off", "0", "no")
+    RATE_CHEAP = config_int(config, "rate_cheap", RATE_CHEAP) if RATE_LIMIT else 0
+    BURST_CHEAP = config_int(config, "burst_cheap", BURST_CHEAP)
+    RATE_EXPENSIVE = config_int(config, "rate_expensive", RATE_EXPENSIVE) if RATE_LIMIT else 0
+    BURST_EXPENSIVE = config_int(config, "burst_expensive", BURST_EXPENSIVE)
+    MAX_CONNECTIONS_PER_SOURCE = config_int(config, "max_connections_per_source", MAX_CONNECTIONS_PER_SOURCE) if RATE_LIMIT else 0
+    cheap_limits = (kws_limits.TokenBuckets(RATE_CHEAP, BURST_CHEAP), kws_limits.TokenBuckets(RATE_CHEAP, BURST_CHEAP))
+    expensive_limits = (kws_limits.TokenBuckets(RATE_EXPENSIVE, BURST_EXPENSIVE),
+                        kws_limits.TokenBuckets(RATE_EXPENSIVE, BURST_EXPENSIVE))
+    connection_limit = kws_limits.ConnectionLimit(MAX_CONNECTIONS_PER_SOURCE)
+    PROFILE_INTERVAL = max(1, config_int(config, "profile_interval", PROFILE_INTERVAL))
+    PROFILE_SAMPLE = config_int(config, "profile_sample", PROFILE_SAMPLE)
+    PROFILE_MEMORY = config.get("profile_memory", "on").strip().lower() not in ("off", "0", "no")
+    CONTROL = config.get("control_socket", "on").strip().lower() not in ("off", "0", "no")
+    LOG_TAIL_LINES = max(1, config_int(config, "log_tail_lines", LOG_TAIL_LINES))
+    log_tail = collections.deque(maxlen=LOG_TAIL_LINES)
+    load_log_tail()
+    COMPACT_INTERVAL = config_int(config, "compact_interval", COMPACT_INTERVAL)
+    JOURNAL_MAX_BYTES = config_int(config, "journal_max_bytes", JOURNAL_MAX_BYTES)
+    log_writer.rotate = True
+    log_writer.max_bytes = config_int(config, "log_max_bytes", log_writer.max_bytes)
+    log_writer.max_age = config_int(config, "log_max_age", log_writer.max_age)
+    log_writer.backups = config_int(config, "log_backups", log_writer.backups)
+    if contact_store.journal_size():
         try:
-            PING_INTERVAL = int(config["ping_interval"])
-        except:
-            pass
+            contact_store.compact()
+        except Exception as e:
+            print("Fehler bei der Kompaktierung der Kontakte:", e)
+    if WORKERS > 1:
+        # Vor allen weiteren Threads abspalten
+        kws_workers.start_workers(WORKERS - 1, worker_main, auth_key, contact_store, log_message, inbox,
+                                  {"claim": claim_id, "remember": remember_id})
+        print(f"kws.py: {WORKERS} Server-Prozesse teilen sich Port {SERVER_PORT}.")
+    if args.profile:
+        # Erst nach dem Abspalten der Worker: profiliert wird nur der Hauptprozess
+        kws_profile.start(PROFILE_FILE, PROFILE_INTERVAL, PROFILE_SAMPLE, PROFILE_MEMORY)
+        print(f"Profiling aktiv, Bericht alle {PROFILE_INTERVAL} s in {PROFILE_FILE}.")
     threading.Thread(target=server_loop, args=(auth_key,), daemon=True).start()
+    if UDP_HEARTBEAT:
+        threading.Thread(target=heartbeat_loop, daemon=True).start()
     threading.Thread(target=ping_contacts, args=(auth_key,), daemon=True).start()
+    threading.Thread(target=compact_contacts, daemon=True).start()
+    if GOSSIP_INTERVAL > 0:
+        threading.Thread(target=gossip_contacts, args=(auth_key,), daemon=True).start()
+    if CONTROL and hasattr(socket, "AF_UNIX"):
+        threading.Thread(target=control_loop, args=(auth_key,), daemon=True).start()
     print("kws.py läuft. Drücke STRG+C zum Beenden.")
     try:
         while True:
             time.sleep(1)
     except KeyboardInterrupt:
         print("Server wird beendet.")
+        log_writer.close()
+        if os.path.exists(CONTROL_SOCKET):
+            os.remove(CONTROL_SOCKET)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,134 @@
+"""
+kws_cdb.py – Binäres Kontaktbuch (contaktd.cdb)
+- Optionale Alternative zu contaktd.cdf für große Kontaktbücher: wird per mmap gelesen,
+  ohne die Datei beim Start zu parsen; Nachschlagen per Binärsuche direkt in der Datei.
+- Aufbau (little endian):
+    Kopf:      MAGIC, Anzahl, Offset Namensindex, Offset IP-Index, Offset Stringtabelle
+    Datensätze: je Kontakt sechs Felder als (Offset, Länge) in der Stringtabelle + Version,
+               sortiert nach auth_id
+    Indizes:   Datensatznummern sortiert nach user_defined_name bzw. ip_address (je 4 Byte)
+    Strings:   UTF-8, gleiche Werte (z. B. Status, Zeitstempel) nur einmal gespeichert
+- Die Datei wird nie verändert, nur als Ganzes neu geschrieben (write_book + os.replace).
+"""
+
+import mmap
+import os
+import struct
+
+from kws_contacts import FIELDS, Contact
+
+MAGIC = b"KWSCDB1\n"
+HEADER = struct.Struct("<8sIIII")
+FIELD = struct.Struct("<IH")  # Offset und Länge eines Strings in der Stringtabelle
+RECORD = struct.Struct("<" + "IH" * len(FIELDS) + "I")
+INDEX = struct.Struct("<I")
+AUTH = FIELDS.index("auth_id")
+NAME = FIELDS.index("user_defined_name")
+IP = FIELDS.index("ip_address")
+
+def write_book(path, contacts):
+    # contacts: beliebige Kontakte (dict oder Contact); schreibt eine vollständige .cdb-Datei
+    contacts = sorted(contacts, key=lambda c: c["auth_id"].encode("utf-8"))
+    strings = bytearray()
+    offsets = {}
+    records = bytearray()
+    for c in contacts:
+        values = []
+        for field in FIELDS:
+            data = c[field].encode("utf-8")
+            offset = offsets.get(data)
+            if offset is None:
+                offset = offsets[data] = len(strings)
+                strings += data
+            values += (offset, len(data))
+        records += RECORD.pack(*values, c.get("version", 0))
+    count = len(contacts)
+    by_name = sorted(range(count), key=lambda i: contacts[i]["user_defined_name"].encode("utf-8"))
+    by_ip = sorted(range(count), key=lambda i: contacts[i]["ip_address"].encode("utf-8"))
+    names_offset = HEADER.size + len(records)
+    ips_offset = names_offset + count * INDEX.size
+    strings_offset = ips_offset + count * INDEX.size
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, count, names_offset, ips_offset, strings_offset))
+        f.write(records)
+        f.write(b"".join(INDEX.pack(i) for i in by_name))
+        f.write(b"".join(INDEX.pack(i) for i in by_ip))
+        f.write(strings)
+        f.flush()
+        os.fsync(f.fileno())
+
+class ContactBook:
+    # Nur-Lese-Zugriff auf eine .cdb-Datei über mmap; liefert Contact-Objekte
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, self._names, self._ips, self._strings = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            self._map.close()
+            raise ValueError(f"{path} ist kein binäres Kontaktbuch")
+
+    def __len__(self):
+        return self.count
+
+    def _raw(self, i, field):
+        offset, length = FIELD.unpack_from(self._map, HEADER.size + i * RECORD.size + field * FIELD.size)
+        start = self._strings + offset
+        return self._map[start:start + length]
+
+    def record(self, i):
+        values = RECORD.unpack_from(self._map, HEADER.size + i * RECORD.size)
+        fields = []
+        for k in range(len(FIELDS)):
+            start = self._strings + values[2 * k]
+            fields.append(self._map[start:start + values[2 * k + 1]].decode("utf-8"))
+        return Contact(*fields, version=values[-1])
+
+    def _index(self, base, n):
+        return INDEX.unpack_from(self._map, base + n * INDEX.size)[0]
+
+    def _lower_bound(self, key, field, base=None):
+        # Erste Position (im Index base oder in der Datensatzreihenfolge), deren Feld >= key ist
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            i = mid if base is None else self._index(base, mid)
+            if self._raw(i, field) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _matches(self, value, field, base):
+        key = value.encode("utf-8")
+        n = self._lower_bound(key, field, base)
+        while n < self.count:
+            i = self._index(base, n)
+            if self._raw(i, field) != key:
+                break
+            yield i
+            n += 1
+
+    def get(self, auth_id):
+        key = auth_id.encode("utf-8")
+        i = self._lower_bound(key, AUTH)
+        if i < self.count and self._raw(i, AUTH) == key:
+            return self.record(i)
+        return None
+
+    def __contains__(self, auth_id):
+        key = auth_id.encode("utf-8")
+        i = self._lower_bound(key, AUTH)
+        return i < self.count and self._raw(i, AUTH) == key
+
+    def by_name(self, user_defined_name):
+        return [self.record(i) for i in self._matches(user_defined_name, NAME, self._names)]
+
+    def by_ip(self, ip_address):
+        return [self.record(i) for i in self._matches(ip_address, IP, self._ips)]
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self.record(i)
+
+    def close(self):
+        self._map.close()
@@ -0,0 +1,480 @@
+"""
+kws_contacts.py – Kontaktspeicher
+- Gemeinsames Modul für kws.py, kws-client.py und kws-service.py.
+- Hält die Kontakte aus contaktd.cdf im Speicher, mit Hash-Indizes nach auth_id,
+  user_defined_name und ip_address (Nachschlagen in O(1)). Intern als Contact-Objekte
+  (__slots__, gemeinsame Strings für Status/Zeitstempel); nach außen als Kopien (dict).
+- Alternativ als binäres Kontaktbuch contaktd.cdb (kws_cdb.py, umwandeln mit
+  kws-convert.py): es wird per mmap gelesen statt geparst, nur die Änderungen aus dem
+  Journal liegen im Speicher; contact_file() wählt die vorhandene Datei.
+- Die Datei wird nur einmal gelesen; vor jedem Zugriff genügt ein stat(), um
+  Änderungen durch andere Prozesse zu erkennen und dann neu zu laden.
+- Änderungen werden als einzelne Kontaktzeilen an ein Journal (contaktd.jrn) angehängt;
+  beim Laden gilt: Snapshot (contaktd.cdf) + Journal, spätere Zeilen gewinnen.
+- Digests (Hashes je Bucket über auth_id + last_contact) für die Delta-Synchronisation.
+- Jeder Kontakt trägt eine Version (optionales 7. Feld, fehlt = 0), die nur bei lokalen
+  Änderungen über add() steigt; beim Zusammenführen gewinnt die höhere Version, bei
+  gleicher Version der jüngere last_contact. Neue Kontakte und Versionssprünge werden
+  als "letzte Änderungen" vermerkt (changes_since) und von kws.py per Gossip verteilt.
+- compact() schreibt den Snapshot atomar neu (temporäre Datei + os.replace) und leert
+  das Journal; kws.py erledigt das periodisch im Hintergrund.
+"""
+
+import hashlib
+import os
+import sys
+import threading
+import zlib
+from datetime import datetime, timedelta
+
+import kws_profile
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+FIELDS = ("username", "auth_id", "last_contact", "user_defined_name", "ip_address", "status")
+
+class Contact:
+    # Kompakte Darstellung eines Kontakts; verhält sich beim Lesen wie ein dict
+    # (c["status"], c.get(...), dict(c)), braucht aber keinen eigenen Hash-Table.
+    __slots__ = FIELDS + ("version",)
+
+    def __init__(self, username, auth_id, last_contact, user_defined_name, ip_address, status, version=0):
+        self.username = username
+        self.auth_id = auth_id
+        self.last_contact = sys.intern(last_contact)
+        self.user_defined_name = user_defined_name
+        self.ip_address = ip_address
+        self.status = sys.intern(status)
+        self.version = version
+
+    @classmethod
+    def from_mapping(cls, c):
+        if isinstance(c, cls):
+            return c
+        return cls(c["username"], c["auth_id"], c["last_contact"], c["user_defined_name"], c["ip_address"],
+                   c["status"], c.get("version", 0))
+
+    def __getitem__(self, key):
+        if key not in _CONTACT_KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in _CONTACT_KEYS else default
+
+    def keys(self):
+        return self.__slots__
+
+    def __eq__(self, other):
+        try:
+            return all(self[key] == other.get(key, 0 if key == "version" else None) for key in self.__slots__)
+        except AttributeError:
+            return NotImplemented
+
+    __hash__ = None
+
+_CONTACT_KEYS = frozenset(Contact.__slots__)
+
+def contact_file(data_dir):
+    # Binäres Kontaktbuch, falls vorhanden (kws-convert.py), sonst contaktd.cdf
+    path = os.path.join(data_dir, "contaktd.cdb")
+    return path if os.path.exists(path) else os.path.join(data_dir, "contaktd.cdf")
+
+def parse_contact_line(line):
+    line = line.strip()
+    if not line:
+        return None
+    if line.endswith("|"):
+        line = line[:-1]
+    parts = line.split(";")
+    if len(parts) < 6:
+        return None
+    contact = dict(zip(FIELDS, parts[:6]))
+    contact["version"] = int(parts[6]) if len(parts) > 6 and parts[6].isdigit() else 0
+    return contact
+
+def parse_contacts_from_string(data):
+    contacts = []
+    with kws_profile.span("contacts.parse"):
+        for line in data.strip().splitlines():
+            contact = parse_contact_line(line)
+            if contact:
+                contacts.append(contact)
+    return contacts
+
+def format_contact(c):
+    # Version 0 wird weggelassen, damit unversionierte Zeilen wie bisher aussehen
+    version = c.get("version", 0)
+    return (f"{c['username']};{c['auth_id']};{c['last_contact']};{c['user_defined_name']};{c['ip_address']};{c['status']}"
+            + (f";{version}" if version else "") + "|")
+
+def format_contacts(contacts):
+    return "".join(format_contact(c) + "\n" for c in contacts)
+
+def is_newer(new_contact, contact):
+    # Höhere Version gewinnt, sonst Last-Writer-Wins: der Datensatz mit dem jüngeren
+    # last_contact gewinnt komplett (alle Felder). Bei Gleichstand bleibt der vorhandene.
+    return ((new_contact.get("version", 0), new_contact["last_contact"])
+            > (contact.get("version", 0), contact["last_contact"]))
+
+def is_fresh(contact, min_interval, now=None):
+    # Online und innerhalb der letzten min_interval Sekunden aufgefrischt
+    now = now or datetime.now()
+    threshold = (now - timedelta(seconds=min_interval)).strftime(TIME_FORMAT)
+    return contact["status"] == "online" and contact["last_contact"] >= threshold
+
+def merge_contacts(existing, new):
+    # Linear über einen Index nach auth_id statt verschachtelter Schleife
+    index = {c["auth_id"]: i for i, c in enumerate(existing)}
+    for new_contact in new:
+        i = index.get(new_contact["auth_id"])
+        if i is None:
+            index[new_contact["auth_id"]] = len(existing)
+            existing.append(new_contact)
+        elif is_newer(new_contact, existing[i]):
+            existing[i] = new_contact
+    return existing
+
+# --- Digests für die Delta-Synchronisation (REQ SYNC) ---
+# Die Kontakte werden per crc32(auth_id) auf n Buckets verteilt; je Bucket wird ein
+# kurzer Hash über die sortierten Paare auth_id|last_contact gebildet. Zwei Knoten
+# vergleichen nur diese Hashes und übertragen danach die Kontakte der abweichenden Buckets.
+
+MIN_BUCKETS = 16
+MAX_BUCKETS = 4096
+
+def digest_buckets_for(count):
+    # Etwa 4 Kontakte pro Bucket, als Zweierpotenz zwischen MIN_ und MAX_BUCKETS
+    n = MIN_BUCKETS
+    while n < MAX_BUCKETS and n * 4 < count:
+        n *= 2
+    return n
+
+def bucket_of(auth_id, n):
+    return zlib.crc32(auth_id.encode("utf-8")) % n
+
+def contact_digest(contacts, n):
+    buckets = [[] for _ in range(n)]
+    for c in contacts:
+        version = c.get("version", 0)
+        buckets[bucket_of(c["auth_id"], n)].append(f"{c['auth_id']}|{c['last_contact']}" + (f"|{version}" if version else ""))
+    digest = []
+    for entries in buckets:
+        h = hashlib.blake2b(digest_size=4)
+        for entry in sorted(entries):
+            h.update(entry.encode("utf-8") + b"\n")
+        digest.append(h.hexdigest())
+    return digest
+
+def diff_buckets(mine, theirs):
+    return [i for i, (a, b) in enumerate(zip(mine, theirs)) if a != b]
+
+def _lock_file(f):
+    # Sperrt Journal-Anhängen gegen gleichzeitige Kompaktierung (nur wo fcntl existiert)
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+class ContactStore:
+    def __init__(self, path):
+        self.path = path
+        self.binary = path.endswith(".cdb")
+        self.journal_path = os.path.splitext(path)[0] + ".jrn"
+        self.lock = threading.RLock()
+        self._snapshot_signature = None
+        self._journal_offset = 0
+        self._book = None  # kws_cdb.ContactBook bei binärem Snapshot
+        self._by_auth = {}  # bei binärem Snapshot nur die Änderungen seit dem Laden
+        self._by_name = {}
+        self._by_ip = {}
+        self._changes = {}  # auth_id -> Änderungsnummer (neuer Kontakt oder neue Version)
+        self.change_seq = 0
+        self.refresh()
+
+    # --- Datei <-> Speicher ---
+
+    def _file_signature(self, path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def _journal_size(self):
+        try:
+            return os.path.getsize(self.journal_path)
+        except OSError:
+            return 0
+
+    def refresh(self):
+        # Snapshot neu laden, wenn er ersetzt wurde; sonst nur neue Journal-Einträge
+        # ab dem zuletzt gelesenen Offset anwenden.
+        with self.lock:
+            signature = self._file_signature(self.path)
+            journal_size = self._journal_size()
+            if signature != self._snapshot_signature or journal_size < self._journal_offset:
+                with kws_profile.span("contacts.load"):
+                    self._load_snapshot(signature)
+                self._snapshot_signature = signature
+                self._journal_offset = 0
+            elif journal_size == self._journal_offset:
+                return False
+            with kws_profile.span("contacts.replay"):
+                self._replay_journal()
+            return True
+
+    def _load_snapshot(self, signature):
+        if self.binary:
+            import kws_cdb  # erst hier, da kws_cdb selbst Contact aus diesem Modul nutzt
+            if self._book is not None:
+                self._book.close()
+            self._book = kws_cdb.ContactBook(self.path) if signature is not None else None
+            self._rebuild([])
+            return
+        contacts = []
+        if signature is not None:
+            with open(self.path, "r") as f:
+                for line in f:
+                    contact = parse_contact_line(line)
+                    if contact:
+                        contacts.append(contact)
+        self._rebuild(contacts)
+
+    def _replay_journal(self):
+        try:
+            with open(self.journal_path, "rb") as f:
+                f.seek(self._journal_offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        # Nur vollständige Datensätze (Zeilenende + abschließendes "|") übernehmen;
+        # eine beim Absturz halb geschriebene letzte Zeile wird ignoriert.
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].decode("utf-8").splitlines():
+            line = line.strip()
+            if line.endswith("|"):
+                contact = parse_contact_line(line)
+                if contact:
+                    self._put(contact)
+        self._journal_offset += end
+
+    def _rebuild(self, contacts):
+        self._by_auth = {}
+        self._by_name = {}
+        self._by_ip = {}
+        for contact in contacts:
+            self._put(contact, track=False)
+
+    def _lookup(self, auth_id):
+        contact = self._by_auth.get(auth_id)
+        if contact is None and self._book is not None:
+            contact = self._book.get(auth_id)
+        return contact
+
+    def _values(self):
+        # Alle Kontakte: Änderungen im Speicher, dazu die nicht überschriebenen aus dem Buch
+        yield from self._by_auth.values()
+        if self._book is not None:
+            for contact in self._book:
+                if contact.auth_id not in self._by_auth:
+                    yield contact
+
+    def _put(self, contact, track=True):
+        contact = Contact.from_mapping(contact)
+        old = self._lookup(contact.auth_id)
+        if old is not None and old.auth_id in self._by_auth:
+            self._unindex(old)
+        if track and (old is None or old.version != contact.version):
+            self.change_seq += 1
+            self._changes[contact.auth_id] = self.change_seq
+        self._by_auth[contact.auth_id] = contact
+        self._by_name[contact.user_defined_name] = contact
+        self._by_ip.setdefault(contact.ip_address, {})[contact.auth_id] = contact
+
+    def _unindex(self, contact):
+        if self._by_name.get(contact.user_defined_name) is contact:
+            del self._by_name[contact.user_defined_name]
+        peers = self._by_ip.get(contact.ip_address)
+        if peers is not None:
+            peers.pop(contact.auth_id, None)
+            if not peers:
+                del self._by_ip[contact.ip_address]
+
+    def _append_journal(self, contacts):
+        # Geänderte Kontakte als vollständige Zeilen anhängen; der Schreibaufwand
+        # hängt nur von der Anzahl der Änderungen ab, nicht von der Größe des Buchs.
+        if not contacts:
+            return
+        with kws_profile.span("contacts.save"), open(self.journal_path, "ab") as f:
+            _lock_file(f)
+            f.write(format_contacts(contacts).encode("utf-8"))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def journal_size(self):
+        return self._journal_size()
+
+    def close(self):
+        # Eingeblendetes Buch freigeben; der nächste Zugriff liest es bei Bedarf neu ein
+        with self.lock:
+            if self._book is not None:
+                self._book.close()
+                self._book = None
+                self._snapshot_signature = None
+
+    def compact(self):
+        # Snapshot aus dem Speicherstand neu schreiben (atomar) und das Journal leeren
+        with self.lock, kws_profile.span("contacts.compact"):
+            with open(self.journal_path, "ab") as journal:
+                _lock_file(journal)
+                self.refresh()
+                tmp_path = self.path + ".tmp"
+                if self.binary:
+                    import kws_cdb
+                    kws_cdb.write_book(tmp_path, self._values())
+                    # Windows ersetzt keine Datei, die noch eingeblendet ist
+                    self.close()
+                else:
+                    with open(tmp_path, "w") as f:
+                        f.write(format_contacts(self._by_auth.values()))
+                        f.flush()
+                        os.fsync(f.fileno())
+                try:
+                    os.replace(tmp_path, self.path)
+                except OSError:
+                    if self.binary:
+                        # Altes Buch samt Journal beim nächsten Zugriff neu einlesen
+                        self._snapshot_signature = None
+                    raise
+                journal.truncate(0)
+            signature = self._file_signature(self.path)
+            if self.binary:
+                # Geschriebenes Buch einblenden; die Änderungen stehen jetzt darin
+                self._load_snapshot(signature)
+            self._snapshot_signature = signature
+            self._journal_offset = 0
+
+    # --- Lesen (liefert Kopien, damit die Indizes konsistent bleiben) ---
+
+    def all(self):
+        with self.lock:
+            self.refresh()
+            return [dict(c) for c in self._values()]
+
+    def __len__(self):
+        with self.lock:
+            self.refresh()
+            if self._book is None:
+                return len(self._by_auth)
+            return len(self._book) + sum(1 for a in self._by_auth if a not in self._book)
+
+    def get(self, auth_id):
+        with self.lock:
+            self.refresh()
+            contact = self._lookup(auth_id)
+            return dict(contact) if contact else None
+
+    def by_name(self, user_defined_name):
+        with self.lock:
+            self.refresh()
+            contact = self._by_name.get(user_defined_name)
+            if contact is None and self._book is not None:
+                contact = next((c for c in self._book.by_name(user_defined_name) if c.auth_id not in self._by_auth), None)
+            return dict(contact) if contact else None
+
+    def by_ip(self, ip_address):
+        with self.lock:
+            self.refresh()
+            contacts = list(self._by_ip.get(ip_address, {}).values())
+            if self._book is not None:
+                contacts += [c for c in self._book.by_ip(ip_address) if c.auth_id not in self._by_auth]
+            return [dict(c) for c in contacts]
+
+    def find(self, identifier):
+        # auth_id oder user_defined_name
+        with self.lock:
+            return self.get(identifier) or self.by_name(identifier)
+
+    def digest(self, n):
+        with self.lock:
+            self.refresh()
+            return contact_digest(self._values(), n)
+
+    def in_buckets(self, buckets, n):
+        buckets = set(buckets)
+        with self.lock:
+            self.refresh()
+            return [dict(c) for c in self._values() if bucket_of(c.auth_id, n) in buckets]
+
+    def changes_since(self, seq):
+        # Kontakte, die nach der Änderungsnummer seq neu hinzukamen oder eine neue Version erhielten
+        with self.lock:
+            self.refresh()
+            changed = sorted((n, a) for a, n in self._changes.items() if n > seq)
+            return [dict(c) for c in (self._lookup(a) for _, a in changed) if c is not None]
+
+    def serialize(self):
+        with self.lock:
+            self.refresh()
+            return format_contacts(self._values()).strip()
+
+    # --- Schreiben (nur Journal-Einträge; Snapshot erst bei compact()) ---
+
+    def add(self, contact):
+        # Lokale Änderung: Version über die bekannte hinaus erhöhen, damit sie sich im Netz durchsetzt
+        with self.lock:
+            self.refresh()
+            old = self._lookup(contact["auth_id"])
+            contact = dict(contact, version=max(contact.get("version", 0), old.version if old else 0) + 1)
+            self._put(contact)
+            self._append_journal([contact])
+
+    def update_many(self, updates):
+        # updates: {auth_id: {feld: wert}}; nur tatsächlich geänderte Kontakte werden geschrieben
+        with self.lock:
+            self.refresh()
+            changed = []
+            for auth_id, fields in updates.items():
+                contact = self._lookup(auth_id)
+                if contact is None:
+                    continue
+                updated = dict(contact)
+                updated.update(fields)
+                if updated != contact:
+                    self._put(updated)
+                    changed.append(updated)
+            self._append_journal(changed)
+            return len(changed)
+
+    def touch(self, auth_id, min_interval=60):
+        # Erfolgreicher Austausch mit dem Kontakt: online + last_contact setzen. Innerhalb von
+        # min_interval Sekunden nach der letzten Auffrischung wird nichts geschrieben.
+        now = datetime.now()
+        with self.lock:
+            self.refresh()
+            contact = self._lookup(auth_id)
+            if contact is None:
+                return False
+            if is_fresh(contact, min_interval, now):
+                return False
+            updated = dict(contact, status="online", last_contact=now.strftime(TIME_FORMAT))
+            self._put(updated)
+            self._append_journal([updated])
+            return True
+
+    def merge(self, new_contacts):
+        # Liefert die Anzahl übernommener (neuer oder aktualisierter) Kontakte
+        with self.lock, kws_profile.span("contacts.merge"):
+            self.refresh()
+            changed = []
+            for new_contact in new_contacts:
+                contact = self._lookup(new_contact["auth_id"])
+                if contact is None or is_newer(new_contact, contact):
+                    contact = Contact.from_mapping(new_contact)
+                    self._put(contact)
+                    changed.append(contact)
+            self._append_journal(changed)
+            return len(changed)
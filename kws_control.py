@@ -0,0 +1,205 @@
+"""
+kws_control.py – Lokaler Steuer-Socket von kws.py
+- kws.py lauscht auf einem Unix-Domain-Socket (kws.sock im Datenordner, nur für den
+  Besitzer lesbar); kws-service.py schickt seine Befehle dorthin, statt auth.key,
+  Kontaktbuch und datatrans.ksys selbst zu lesen und eigene Verbindungen aufzubauen.
+- Gerahmt wie kws_proto (4 Byte Länge + UTF-8), Inhalt JSON:
+    Anfrage: {"cmd": "<befehl>", ...Argumente}
+    Antwort: {"ok": true, "result": ..., "log": [Meldungen]} oder {"ok": false, "error": "..."}
+- Befehle: auth, find, list, add, message, broadcast, request, stats, messages (Posteingang), log.
+- Commands führt die Befehle aus; dieselbe Klasse nutzt kws-service.py über LocalClient
+  direkt, wenn kws.py nicht läuft.
+"""
+
+import json
+import os
+import socket
+import threading
+
+import kws_proto
+from kws_send import Sender
+
+SOCKET_NAME = "kws.sock"
+
+def socket_path(data_dir):
+    return os.path.join(data_dir, SOCKET_NAME)
+
+class Commands:
+    def __init__(self, auth_key, contact_store, outbox, routes, log, own_stats, recent_log, inbox, relay_hops=2):
+        self.auth_key = auth_key
+        self.contact_store = contact_store
+        self.outbox = outbox
+        self.routes = routes
+        self.log = log
+        self.own_stats = own_stats  # () -> Statistik-Text des eigenen kws.py
+        self.recent_log = recent_log  # (limit) -> letzte Zeilen von datatrans.ksys
+        self.inbox = inbox  # kws_inbox.Inbox
+        self.relay_hops = relay_hops
+
+    def dispatch(self, request):
+        lines = []
+        def log(message):
+            self.log(message)
+            lines.append(message)
+        handler = getattr(self, "cmd_" + str(request.get("cmd", "")), None)
+        if handler is None:
+            return {"ok": False, "error": f"Unbekannter Befehl: {request.get('cmd')}"}
+        args = {k: v for k, v in request.items() if k != "cmd"}
+        try:
+            result = handler(Sender(self.contact_store, self.outbox, self.routes, log, self.relay_hops), **args)
+        except Exception as e:
+            return {"ok": False, "error": str(e), "log": lines}
+        return {"ok": True, "result": result, "log": lines}
+
+    def cmd_auth(self, sender):
+        return self.auth_key
+
+    def cmd_find(self, sender, identifier):
+        contact = self.contact_store.find(identifier)
+        return dict(contact) if contact else None
+
+    def cmd_list(self, sender):
+        return [dict(c) for c in self.contact_store.all()]
+
+    def cmd_add(self, sender, contact):
+        self.contact_store.add(contact)
+        return True
+
+    def cmd_message(self, sender, name, text):
+        target = self.contact_store.by_name(name)
+        if not target:
+            return None
+        return sender.message(target["ip_address"], text, self.auth_key, target["auth_id"])
+
+    def cmd_broadcast(self, sender, text, names=None, online_only=False):
+        # names: Anzeigenamen/auth_ids der Gruppe, None = alle Kontakte
+        if names is None:
+            targets = [c for c in self.contact_store.all() if c["auth_id"] != self.auth_key]
+            missing = []
+        else:
+            found = {name: self.contact_store.find(name) for name in names}
+            targets = list({c["auth_id"]: c for c in found.values() if c}.values())
+            missing = [name for name, c in found.items() if not c]
+        if online_only:
+            targets = [c for c in targets if c["status"] == "online"]
+        counts, failed, elapsed = sender.broadcast(targets, text, self.auth_key) if targets else ({}, [], 0.0)
+        return {"targets": len(targets), "counts": counts, "elapsed": elapsed, "missing": missing,
+                "failed": [[c["user_defined_name"], status] for c, status in failed]}
+
+    def cmd_request(self, sender, identifier, command):
+        target = self.contact_store.find(identifier)
+        if not target:
+            return None
+        ip, auth = target["ip_address"], target["auth_id"]
+        command = command.lower()
+        if command == "addlist":
+            # Die eigene Kontaktliste als Payload
+            sender.request(ip, auth, "ADDLIST", self.auth_key, self.contact_store.serialize())
+        elif command == "sync":
+            sender.sync(ip, auth, self.auth_key)
+        elif command == "stats":
+            reply = sender.request(ip, auth, "STATS", self.auth_key, queue=False)
+            return {"ip": ip, "reply": reply}
+        else:
+            sender.request(ip, auth, command, self.auth_key)
+        return {"ip": ip}
+
+    def cmd_stats(self, sender):
+        return self.own_stats()
+
+    def cmd_log(self, sender, limit=0):
+        return self.recent_log(limit)
+
+    def cmd_messages(self, sender, since=None, sender_name=None, last=0, after=0):
+        # sender_name: Anzeigename oder auth_id; Absender werden in den Nachrichten
+        # zusätzlich mit Anzeigenamen ("name") geliefert, soweit bekannt
+        sender_auth = None
+        if sender_name:
+            contact = self.contact_store.find(sender_name)
+            sender_auth = contact["auth_id"] if contact else sender_name
+        messages, count = self.inbox.query(since, sender_auth, last, after)
+        for m in messages:
+            contact = self.contact_store.get(m["from"])
+            m["name"] = contact["user_defined_name"] if contact else None
+        return {"messages": messages, "count": count}
+
+def handle_connection(conn, commands):
+    reader = kws_proto.FrameReader(conn)
+    try:
+        while True:
+            frame = reader.read_frame()
+            if frame is None:
+                return
+            try:
+                reply = commands.dispatch(json.loads(frame))
+            except ValueError:
+                reply = {"ok": False, "error": "Ungültige Anfrage"}
+            conn.sendall(kws_proto.encode_frame(json.dumps(reply)))
+    except (OSError, kws_proto.FrameError):
+        pass
+    finally:
+        conn.close()
+
+def serve(path, commands):
+    # Blockiert; als Daemon-Thread starten. Eine verwaiste kws.sock wird ersetzt.
+    if os.path.exists(path):
+        os.remove(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o177)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(old_umask)
+    server.listen()
+    while True:
+        conn, _ = server.accept()
+        threading.Thread(target=handle_connection, args=(conn, commands), daemon=True).start()
+
+class ControlError(Exception):
+    pass
+
+class SocketClient:
+    def __init__(self, sock):
+        self.sock = sock
+        self.reader = kws_proto.FrameReader(sock)
+
+    def call(self, cmd, **args):
+        # Liefert (result, log); Fehler von kws.py als ControlError
+        self.sock.sendall(kws_proto.encode_frame(json.dumps(dict(args, cmd=cmd))))
+        frame = self.reader.read_frame()
+        if frame is None:
+            raise ControlError("kws.py hat die Verbindung geschlossen")
+        reply = json.loads(frame)
+        if not reply["ok"]:
+            raise ControlError(reply["error"])
+        return reply["result"], reply["log"]
+
+    def close(self):
+        self.sock.close()
+
+class LocalClient:
+    # Gleiche Schnittstelle wie SocketClient, führt die Befehle aber im eigenen Prozess aus
+    def __init__(self, commands):
+        self.commands = commands
+
+    def call(self, cmd, **args):
+        reply = self.commands.dispatch(dict(args, cmd=cmd))
+        if not reply["ok"]:
+            raise ControlError(reply["error"])
+        return reply["result"], reply["log"]
+
+    def close(self):
+        pass
+
+def connect(path, timeout=None):
+    # SocketClient, falls kws.py läuft, sonst None
+    if not hasattr(socket, "AF_UNIX") or not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    return SocketClient(sock)
@@ -0,0 +1,103 @@
+"""
+kws_inbox.py – Posteingang empfangener Nachrichten
+- Nur MSG landen hier, nicht PING/INFO usw. (die bleiben im Log datatrans.ksys).
+- inbox.msg: eine JSON-Zeile pro Nachricht {"time", "sent", "from", "text"} (nur Anhängen).
+- inbox.idx: fester Datensatz pro Nachricht (Empfangszeit, Offset in inbox.msg, Hash der
+  Absender-auth_id). Die Empfangszeiten sind aufsteigend, "seit"-Abfragen suchen daher per
+  Binärsuche im Index; Absenderfilter vergleichen nur die 24-Byte-Datensätze. Gelesen
+  werden jeweils nur die passenden Zeilen aus inbox.msg (seek).
+- Eine Nachricht heißt n-te Nachricht nach ihrer Position im Index; "after" in query()
+  liefert nur neuere Nachrichten (Folgemodus von "Show --follow").
+"""
+
+import hashlib
+import json
+import os
+import struct
+import threading
+import time
+from datetime import datetime
+
+from kws_contacts import TIME_FORMAT
+
+ENTRY = struct.Struct("<dQ8s")  # Empfangszeit, Offset in inbox.msg, Absender-Hash
+
+def sender_key(auth_id):
+    return hashlib.blake2b(auth_id.encode("utf-8"), digest_size=8).digest()
+
+class Inbox:
+    def __init__(self, data_dir):
+        self.msg_path = os.path.join(data_dir, "inbox.msg")
+        self.idx_path = os.path.join(data_dir, "inbox.idx")
+        self.lock = threading.Lock()
+        self._last_time = 0.0
+
+    def append(self, sender_auth, sent, text):
+        with self.lock:
+            # Nie rückwärts, auch wenn die Uhr zurückgestellt wird, damit der Index sortiert bleibt
+            if not self._last_time:
+                self._last_time = self._repair()
+            now = max(time.time(), self._last_time)
+            self._last_time = now
+            record = {"time": datetime.fromtimestamp(now).strftime(TIME_FORMAT), "sent": sent,
+                      "from": sender_auth, "text": text}
+            with open(self.msg_path, "ab") as f:
+                offset = f.tell()
+                f.write((json.dumps(record) + "\n").encode("utf-8"))
+            # Index erst nach der Nachricht, damit er nie auf fehlende Daten zeigt
+            with open(self.idx_path, "ab") as f:
+                f.write(ENTRY.pack(now, offset, sender_key(sender_auth)))
+
+    def _repair(self):
+        # Unvollständigen letzten Datensatz (Absturz beim Schreiben) abschneiden; liefert
+        # die Empfangszeit der letzten Nachricht
+        count = self.count()
+        if not os.path.exists(self.idx_path):
+            return 0.0
+        with open(self.idx_path, "r+b") as f:
+            f.truncate(count * ENTRY.size)
+            if not count:
+                return 0.0
+            f.seek((count - 1) * ENTRY.size)
+            return ENTRY.unpack(f.read(ENTRY.size))[0]
+
+    def count(self):
+        try:
+            return os.path.getsize(self.idx_path) // ENTRY.size
+        except OSError:
+            return 0
+
+    def _lower_bound(self, f, count, since):
+        # Erste Position mit Empfangszeit >= since
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            f.seek(mid * ENTRY.size)
+            if ENTRY.unpack(f.read(ENTRY.size))[0] < since:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def query(self, since=None, sender=None, last=0, after=0):
+        # since: Unix-Zeit, sender: auth_id, last: nur die letzten N Treffer,
+        # after: nur Nachrichten ab dieser Position. Liefert (Nachrichten, Anzahl insgesamt).
+        count = self.count()
+        if count <= after:
+            return [], count
+        with open(self.idx_path, "rb") as idx:
+            start = after
+            if since is not None:
+                start = max(start, self._lower_bound(idx, count, since))
+            idx.seek(start * ENTRY.size)
+            data = idx.read((count - start) * ENTRY.size)
+        key = sender_key(sender) if sender else None
+        offsets = [offset for _, offset, k in ENTRY.iter_unpack(data) if key is None or k == key]
+        if last:
+            offsets = offsets[-last:]
+        messages = []
+        with open(self.msg_path, "rb") as f:
+            for offset in offsets:
+                f.seek(offset)
+                messages.append(json.loads(f.readline()))
+        return messages, count
@@ -0,0 +1,63 @@
+"""
+kws_limits.py – Zulassungskontrolle für eingehende Anfragen
+- TokenBuckets: je Schlüssel (Quell-IP oder auth_id) ein Eimer mit burst Marken, der mit
+  rate Marken pro Sekunde nachgefüllt wird; jede Anfrage kostet eine Marke. Ist der Eimer
+  leer, wird die Anfrage mit "BUSY" abgewiesen. Höchstens max_keys Eimer werden gehalten,
+  der am längsten unbenutzte fällt heraus.
+- ConnectionLimit: höchstens limit gleichzeitige Verbindungen je Quell-IP.
+- Die auth_id im Befehl ist nicht geprüft; der Eimer je Quell-IP bleibt daher der
+  eigentliche Schutz, der je auth_id verhindert nur, dass eine ID über viele Adressen
+  hinweg unbegrenzt Anfragen stellt.
+"""
+
+import collections
+import threading
+import time
+
+MAX_KEYS = 10000
+
+class TokenBuckets:
+    def __init__(self, rate, burst, max_keys=MAX_KEYS):
+        self.rate = rate  # Marken pro Sekunde, 0 = unbegrenzt
+        self.burst = max(1, burst)
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+        self._buckets = collections.OrderedDict()  # Schlüssel -> [Marken, Zeitpunkt]
+
+    def allow(self, key, cost=1):
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [self.burst, now]
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] < cost:
+                return False
+            bucket[0] -= cost
+            return True
+
+class ConnectionLimit:
+    def __init__(self, limit):
+        self.limit = limit  # 0 = unbegrenzt
+        self.lock = threading.Lock()
+        self._active = collections.Counter()
+
+    def acquire(self, key):
+        with self.lock:
+            if self.limit and self._active[key] >= self.limit:
+                return False
+            self._active[key] += 1
+            return True
+
+    def release(self, key):
+        with self.lock:
+            self._active[key] -= 1
+            if self._active[key] <= 0:
+                del self._active[key]
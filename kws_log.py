@@ -0,0 +1,107 @@
+"""
+kws_log.py – Gepufferter Log-Schreiber
+- Log-Zeilen werden über eine Queue an einen Hintergrund-Thread übergeben; der Aufrufer
+  formatiert nur die Zeile (Zeitstempel zum Zeitpunkt des Aufrufs) und kehrt sofort zurück.
+- Der Thread schreibt gesammelt, sobald flush_bytes erreicht sind oder flush_interval
+  Sekunden vergangen sind, und öffnet die Datei dafür jeweils nur einmal pro Block.
+- Optional Rotation nach Größe (max_bytes) oder Alter (max_age): datatrans.ksys wird zu
+  datatrans.ksys.1, .1 zu .2 usw.; es bleiben höchstens backups alte Dateien erhalten.
+- Format wie bisher: "[YYYY-MM-DD HH:MM:SS] Nachricht".
+"""
+
+import atexit
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+import kws_profile
+
+FLUSH_BYTES = 64 * 1024
+FLUSH_INTERVAL = 1.0  # Sekunden
+
+class LogWriter:
+    def __init__(self, path, rotate=False, max_bytes=10 * 1024 * 1024, max_age=0, backups=5,
+                 flush_bytes=FLUSH_BYTES, flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        self.rotate = rotate
+        self.max_bytes = max_bytes
+        self.max_age = max_age  # 0 = keine Rotation nach Alter
+        self.backups = backups
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue()
+        self._started = time.time()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def write(self, message):
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self._queue.put(f"[{timestamp}] {message}\n")
+
+    def flush(self):
+        # Blockiert, bis alle bisher übergebenen Zeilen geschrieben sind
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait(5)
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(5)
+
+    def _run(self):
+        buf = []
+        size = 0
+        last_flush = time.time()
+        while True:
+            timeout = max(0.0, self.flush_interval - (time.time() - last_flush))
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = False
+            if isinstance(item, str):
+                buf.append(item)
+                size += len(item)
+                if size < self.flush_bytes and time.time() - last_flush < self.flush_interval:
+                    continue
+            if buf:
+                self._write(buf)
+                buf = []
+                size = 0
+            last_flush = time.time()
+            if isinstance(item, threading.Event):
+                item.set()
+            elif item is None:
+                return
+
+    def _write(self, lines):
+        try:
+            with kws_profile.span("log.write"):
+                if self.rotate:
+                    self._maybe_rotate()
+                with open(self.path, "a") as f:
+                    f.write("".join(lines))
+        except Exception as e:
+            print("Fehler beim Schreiben des Logs:", e)
+
+    def _maybe_rotate(self):
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return
+        too_big = self.max_bytes and size >= self.max_bytes
+        too_old = self.max_age and time.time() - self._started >= self.max_age
+        if not (too_big or too_old) or size == 0:
+            return
+        for i in range(self.backups - 1, 0, -1):
+            src = f"{self.path}.{i}"
+            if os.path.exists(src):
+                os.replace(src, f"{self.path}.{i + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._started = time.time()
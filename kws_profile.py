@@ -0,0 +1,116 @@
+"""
+kws_profile.py – Profiling-Modus von kws.py (python3 kws.py --profile)
+- span(name): Zeitmessung eines Abschnitts (with span("contacts.merge"): ...). Ohne
+  --profile liefert span() nur einen leeren Kontextmanager; das kostet einen Funktionsaufruf.
+- sample(func, *args): jede sample_every-te Anfrage läuft unter cProfile (immer nur eine
+  gleichzeitig, damit sich die Profiler nicht in die Quere kommen).
+- tracemalloc (optional): zu jedem Bericht ein Schnappschuss, verglichen mit dem vorigen.
+- Alle interval Sekunden hängt ein Hintergrund-Thread einen Bericht an profile.txt an:
+  Abschnitte (Anzahl, Mittel, p50/p99, Maximum, Summe), die teuersten Funktionen der
+  gesampelten Anfragen und das Speicherwachstum je Quellzeile. Danach beginnt die
+  Messung neu, jeder Bericht deckt also nur sein Intervall ab.
+"""
+
+import contextlib
+import cProfile
+import io
+import pstats
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+
+from kws_stats import Stats
+
+enabled = False
+sample_every = 100
+_spans = Stats()
+_profiles = []  # cProfile.Profile der gesampelten Aufrufe im aktuellen Intervall
+_profile_lock = threading.Lock()  # immer nur ein aktiver Profiler
+_counter_lock = threading.Lock()
+_calls = 0
+_last_snapshot = None
+_NOOP = contextlib.nullcontext()
+
+class _Span:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        _spans.observe(self.name, time.perf_counter() - self.start)
+        return False
+
+def span(name):
+    return _Span(name) if enabled else _NOOP
+
+def sample(func, *args):
+    global _calls
+    if not enabled:
+        return func(*args)
+    with _counter_lock:
+        _calls += 1
+        due = _calls % sample_every == 0
+    if not due or not _profile_lock.acquire(blocking=False):
+        return func(*args)
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(func, *args)
+    finally:
+        _profile_lock.release()
+        with _counter_lock:
+            _profiles.append(profile)
+
+def start(path, interval=60, sample_rate=100, memory=True):
+    global enabled, sample_every, _last_snapshot
+    sample_every = max(1, sample_rate)
+    if memory:
+        tracemalloc.start()
+        _last_snapshot = tracemalloc.take_snapshot()
+    enabled = True
+    threading.Thread(target=_report_loop, args=(path, interval), daemon=True).start()
+
+def _report_loop(path, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            report = format_report(interval)
+            with open(path, "a") as f:
+                f.write(report)
+        except Exception as e:
+            print("Fehler beim Schreiben des Profiling-Berichts:", e)
+
+def format_report(interval):
+    global _spans, _profiles, _last_snapshot
+    # Messwerte des Intervalls übernehmen und neu beginnen
+    spans, _spans = _spans, Stats()
+    with _counter_lock:
+        profiles, _profiles = _profiles, []
+    out = io.StringIO()
+    out.write(f"=== {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} (letzte {interval} s) ===\n")
+    out.write(f"{'Abschnitt':<22} {'Anzahl':>8} {'Mittel':>9} {'p50<=':>8} {'p99<=':>8} {'Max':>9} {'Summe':>10}\n")
+    with spans.lock:
+        rows = sorted(spans.histograms.items(), key=lambda item: -item[1].total_ms)
+        for name, h in rows:
+            out.write(f"{name:<22} {h.count:>8} {h.total_ms / h.count:>7.2f}ms {h.percentile(50):>6}ms "
+                      f"{h.percentile(99):>6}ms {h.max_ms:>7.2f}ms {h.total_ms:>8.1f}ms\n")
+    if profiles:
+        out.write(f"\ncProfile ({len(profiles)} gesampelte Anfragen, jede {sample_every}.), nach Gesamtzeit:\n")
+        stats = pstats.Stats(profiles[0], stream=out)
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.sort_stats("cumulative").print_stats(20)
+    if _last_snapshot is not None:
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        out.write(f"\nSpeicher (tracemalloc): aktuell {current / 1024:.0f} KB, Spitze {peak / 1024:.0f} KB; "
+                  "größtes Wachstum seit dem letzten Bericht:\n")
+        for diff in snapshot.compare_to(_last_snapshot, "lineno")[:10]:
+            out.write(f"  {diff}\n")
+        _last_snapshot = snapshot
+    out.write("\n")
+    return out.getvalue()
@@ -0,0 +1,438 @@
+"""
+kws_proto.py – Wire-Protokoll
+- Gerahmtes Protokoll (Version 1): 4-Byte-Längenkopf (big endian) + UTF-8-Nutzdaten.
+- Aushandlung: Der Client sendet zuerst MAGIC; ein aktueller Server antwortet mit MAGIC,
+  ein alter Server antwortet "UNKNOWN_COMMAND" und schließt – dann wird das alte
+  Einmal-Format (ein Befehl pro Verbindung) verwendet.
+- Auf einer gerahmten Verbindung können beliebig viele MSG/REQ-Frames nacheinander
+  (auch gepipelined) gesendet werden; die Antworten kommen in derselben Reihenfolge.
+- Adressen von Gegenstellen dürfen einen Port enthalten ("host:port"), sonst gilt Port 5000.
+- ConnectionPool hält diese Verbindungen je Gegenstelle offen und verwendet sie für alle
+  Sender eines Prozesses wieder (Leerlauf-Timeout, Gesundheitsprüfung, Limit je Gegenstelle).
+- Nachrichten-IDs: MSG und REQ tragen eine ID am Befehlswort ("MSG#<id>;..."), die beim
+  Wiederholen gleich bleibt, damit der Empfänger Duplikate verwerfen kann. Antwortet eine
+  ältere Gegenstelle darauf "UNKNOWN_COMMAND", wird ohne ID erneut gesendet (je Gegenstelle gemerkt).
+- Was über alte Gegenstellen gelernt wurde (altes Format, kein BATCH, keine IDs), gilt nur
+  PEER_MARK_TTL Sekunden; danach wird neu ausgehandelt, falls sie inzwischen aktualisiert wurde.
+- BATCH: viele MSG an eine Gegenstelle in einem Frame, "BATCH;<auth>;<JSON [[id, msg], ...]>";
+  die Antwort "BATCH_RECEIVED;<id>,<id>,..." nennt die angenommenen Nachrichten. Gegenstellen
+  ohne BATCH erhalten die Nachrichten einzeln (gepipelined).
+- Heartbeat über UDP (gleicher Port): "PING;<auth>;<nonce>" wird mit "PONG;<nonce>"
+  beantwortet; udp_ping_many sendet die Datagramme gesammelt und wartet eine Frist ab.
+- "BUSY" (Gegenstelle überlastet oder Limit erreicht) melden exchange und send_batch als
+  PeerBusy, damit es nicht als Antwort, altes Protokoll oder fehlendes BATCH missverstanden
+  wird; send_many liefert "BUSY" als Antwort des betroffenen Frames (der Rest kann
+  angenommen sein).
+"""
+
+import contextlib
+import json
+import os
+import select
+import socket
+import struct
+import threading
+import time
+
+DEFAULT_PORT = 5000
+MAGIC = b"KWSF/1\n"
+HEADER = struct.Struct(">I")
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+PIPELINE_WINDOW = 32  # max. unbeantwortete Frames, damit sich beide Seiten nicht blockieren
+POOL_MAX_PER_PEER = 4  # max. gleichzeitige Verbindungen je Gegenstelle
+POOL_IDLE_TIMEOUT = 60  # ungenutzte Verbindungen so lange offen halten (in Sekunden)
+UDP_MAX_DATAGRAM = 512
+BATCH_MAX = 256  # max. Nachrichten pro BATCH-Frame
+PEER_MARK_TTL = 300  # so lange gilt eine Gegenstelle als alt, danach wird neu ausgehandelt (in Sekunden)
+
+class PeerMarks:
+    # Menge von Gegenstellen (host, port) mit Zeitstempel; Einträge verfallen nach ttl
+    # Sekunden, damit eine inzwischen aktualisierte Gegenstelle wieder erkannt wird
+    def __init__(self, ttl=PEER_MARK_TTL):
+        self.ttl = ttl
+        self._marks = {}
+
+    def add(self, key):
+        self._marks[key] = time.time()
+
+    def discard(self, key):
+        self._marks.pop(key, None)
+
+    def __contains__(self, key):
+        marked = self._marks.get(key)
+        if marked is None:
+            return False
+        if time.time() - marked < self.ttl:
+            return True
+        self._marks.pop(key, None)
+        return False
+
+# Gegenstellen, die nur das alte Einmal-Format, kein BATCH bzw. keine Nachrichten-IDs können
+_peer_legacy = PeerMarks()
+_peer_no_batch = PeerMarks()
+_peer_no_ids = PeerMarks()
+
+class FrameError(Exception):
+    pass
+
+class PeerBusy(OSError):
+    pass
+
+def split_address(address, default_port=DEFAULT_PORT):
+    # "host", "host:port", "[v6]:port" oder eine reine IPv6-Adresse -> (host, port)
+    if address.startswith("["):
+        host, _, rest = address[1:].partition("]")
+        port = rest[1:] if rest.startswith(":") else ""
+    elif address.count(":") == 1:
+        host, port = address.split(":")
+    else:
+        host, port = address, ""
+    return host, int(port) if port.isdigit() else default_port
+
+def new_message_id():
+    return os.urandom(8).hex()
+
+def split_id(message):
+    # "MSG#<id>;..." -> ("MSG;...", "<id>"); ohne ID -> (message, None)
+    head, sep, rest = message.partition(";")
+    command, _, msg_id = head.partition("#")
+    return command + sep + rest, msg_id or None
+
+def with_id(message, msg_id=None):
+    # Hängt eine (neue) ID an das Befehlswort; eine vorhandene ID bleibt erhalten
+    if split_id(message)[1]:
+        return message
+    head, sep, rest = message.partition(";")
+    return f"{head}#{msg_id or new_message_id()}{sep}{rest}"
+
+def strip_id(message):
+    return split_id(message)[0]
+
+def is_msg(message):
+    return strip_id(message).startswith("MSG;")
+
+def encode_frame(text):
+    body = text.encode("utf-8")
+    return HEADER.pack(len(body)) + body
+
+def is_magic_prefix(data):
+    # True, solange die bisher gelesenen Bytes noch zum Handshake gehören könnten
+    return len(data) < len(MAGIC) and MAGIC.startswith(data)
+
+class FrameReader:
+    # Liest Frames von einem blockierenden Socket; buf enthält bereits gelesene Bytes.
+    # timed: Kontextmanager-Fabrik, die das Lesen jedes Frames ab dem vollständigen Kopf
+    # umschließt (Profiling; das Warten auf den nächsten Frame zählt nicht mit)
+    def __init__(self, sock, buf=b"", timed=contextlib.nullcontext):
+        self.sock = sock
+        self.buf = bytearray(buf)
+        self.timed = timed
+
+    def _read_exact(self, n):
+        while len(self.buf) < n:
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                return None
+            self.buf += chunk
+        data = bytes(self.buf[:n])
+        del self.buf[:n]
+        return data
+
+    def read_frame(self):
+        header = self._read_exact(HEADER.size)
+        if header is None:
+            return None
+        with self.timed():
+            (length,) = HEADER.unpack(header)
+            if length > MAX_FRAME_SIZE:
+                raise FrameError(f"Frame zu groß: {length} Bytes")
+            body = self._read_exact(length)
+            if body is None:
+                raise FrameError("Verbindung mitten im Frame geschlossen")
+            return body.decode("utf-8")
+
+class AsyncFrameReader:
+    # Gegenstück zu FrameReader für asyncio.StreamReader
+    def __init__(self, reader, buf=b"", timed=contextlib.nullcontext):
+        self.reader = reader
+        self.buf = bytearray(buf)
+        self.timed = timed
+
+    async def _read_exact(self, n):
+        while len(self.buf) < n:
+            chunk = await self.reader.read(65536)
+            if not chunk:
+                return None
+            self.buf += chunk
+        data = bytes(self.buf[:n])
+        del self.buf[:n]
+        return data
+
+    async def read_frame(self):
+        header = await self._read_exact(HEADER.size)
+        if header is None:
+            return None
+        with self.timed():
+            (length,) = HEADER.unpack(header)
+            if length > MAX_FRAME_SIZE:
+                raise FrameError(f"Frame zu groß: {length} Bytes")
+            body = await self._read_exact(length)
+            if body is None:
+                raise FrameError("Verbindung mitten im Frame geschlossen")
+            return body.decode("utf-8")
+
+class FramedConnection:
+    # Dauerhafte Verbindung zu einer Gegenstelle im gerahmten Protokoll
+    def __init__(self, host, port, timeout=5):
+        self.host = host
+        self.port = port
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        try:
+            # Kleine Frames sofort senden (kein Nagle-Verzug bei gepipelinten Anfragen)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.sock.sendall(MAGIC)
+            reply = b""
+            while len(reply) < len(MAGIC):
+                chunk = self.sock.recv(len(MAGIC) - len(reply))
+                if not chunk:
+                    break
+                reply += chunk
+            if reply == b"BUSY":
+                raise PeerBusy(f"{host}:{port} ist ausgelastet (BUSY)")
+            if reply != MAGIC:
+                raise FrameError("Gegenstelle unterstützt kein gerahmtes Protokoll")
+        except Exception:
+            self.sock.close()
+            raise
+        self.reader = FrameReader(self.sock)
+
+    def request(self, message):
+        return self.pipeline([message])[0]
+
+    def pipeline(self, messages):
+        replies = []
+        for start in range(0, len(messages), PIPELINE_WINDOW):
+            window = messages[start:start + PIPELINE_WINDOW]
+            self.sock.sendall(b"".join(encode_frame(m) for m in window))
+            for _ in window:
+                reply = self.reader.read_frame()
+                if reply is None:
+                    raise FrameError("Verbindung vor der Antwort geschlossen")
+                replies.append(reply)
+        return replies
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+def legacy_exchange(host, port, message, timeout=5):
+    # Altes Format: ein Befehl pro Verbindung; der Server schließt nach der Antwort,
+    # daher wird bis EOF gelesen (keine Kürzung auf 4 KB mehr).
+    s = socket.create_connection((host, port), timeout=timeout)
+    try:
+        s.sendall(message.encode("utf-8"))
+        chunks = []
+        while True:
+            chunk = s.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return b"".join(chunks).decode("utf-8")
+    finally:
+        s.close()
+
+def open_connection(host, port, timeout=5):
+    # Liefert eine FramedConnection oder None, wenn die Gegenstelle nur das alte Format kann
+    key = (host, port)
+    if key in _peer_legacy:
+        return None
+    try:
+        conn = FramedConnection(host, port, timeout)
+    except FrameError:
+        _peer_legacy.add(key)
+        return None
+    return conn
+
+class ConnectionPool:
+    # Wiederverwendbare gerahmte Verbindungen je Gegenstelle (host, port):
+    # - höchstens max_per_peer Verbindungen gleichzeitig pro Gegenstelle
+    # - ungenutzte Verbindungen werden nach idle_timeout Sekunden geschlossen
+    # - vor der Wiederverwendung prüft ein select(), ob die Gegenstelle inzwischen geschlossen hat
+    def __init__(self, max_per_peer=POOL_MAX_PER_PEER, idle_timeout=POOL_IDLE_TIMEOUT):
+        self.max_per_peer = max_per_peer
+        self.idle_timeout = idle_timeout
+        self.cond = threading.Condition()
+        self._idle = {}  # (host, port) -> [(FramedConnection, zuletzt benutzt)]
+        self._open = {}  # (host, port) -> Anzahl offener Verbindungen (frei + belegt)
+
+    def _healthy(self, conn, last_used):
+        if time.time() - last_used > self.idle_timeout:
+            return False
+        try:
+            readable, _, _ = select.select([conn.sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        # Lesbar ohne offene Anfrage heißt: EOF oder unerwartete Daten
+        return not readable
+
+    def _discard(self, key, conn):
+        conn.close()
+        self._open[key] -= 1
+        self.cond.notify()
+
+    def acquire(self, host, port, timeout=5):
+        # Liefert (FramedConnection, wiederverwendet) oder (None, False) bei alten Gegenstellen
+        key = (host, port)
+        deadline = time.time() + timeout
+        with self.cond:
+            while True:
+                idle = self._idle.get(key)
+                while idle:
+                    conn, last_used = idle.pop()
+                    if self._healthy(conn, last_used):
+                        return conn, True
+                    self._discard(key, conn)
+                if self._open.get(key, 0) < self.max_per_peer:
+                    self._open[key] = self._open.get(key, 0) + 1
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise FrameError(f"Verbindungslimit für {host}:{port} erreicht")
+                self.cond.wait(remaining)
+        conn = None
+        try:
+            conn = open_connection(host, port, timeout)
+        finally:
+            if conn is None:
+                with self.cond:
+                    self._open[key] -= 1
+                    self.cond.notify()
+        return conn, False
+
+    def release(self, conn, ok=True):
+        key = (conn.host, conn.port)
+        with self.cond:
+            if ok:
+                self._idle.setdefault(key, []).append((conn, time.time()))
+                self.cond.notify()
+            else:
+                self._discard(key, conn)
+
+    def close_idle(self):
+        # Abgelaufene freie Verbindungen schließen
+        with self.cond:
+            for key, idle in self._idle.items():
+                keep = []
+                for conn, last_used in idle:
+                    if self._healthy(conn, last_used):
+                        keep.append((conn, last_used))
+                    else:
+                        self._discard(key, conn)
+                self._idle[key] = keep
+
+    def send_many(self, host, port, messages, timeout=5):
+        conn, reused = self.acquire(host, port, timeout)
+        if conn is None:
+            return [legacy_exchange(host, port, m, timeout) for m in messages]
+        try:
+            replies = conn.pipeline(messages)
+        except (OSError, FrameError):
+            self.release(conn, ok=False)
+            if not reused:
+                raise
+            # Wiederverwendete Verbindung war veraltet: einmal mit frischer Verbindung wiederholen
+            return self.send_many(host, port, messages, timeout)
+        self.release(conn)
+        return replies
+
+# Gemeinsamer Pool für alle Sender eines Prozesses
+pool = ConnectionPool()
+
+def send_many(host, port, messages, timeout=5):
+    # Sendet mehrere Nachrichten an eine Gegenstelle, gerahmt über eine (wiederverwendete)
+    # Verbindung aus dem Pool (gepipelined) oder – bei alten Gegenstellen – einzeln im alten Format.
+    key = (host, port)
+    if key in _peer_no_ids:
+        messages = [strip_id(m) for m in messages]
+    replies = pool.send_many(host, port, messages, timeout)
+    retry = [i for i, m in enumerate(messages) if replies[i] == "UNKNOWN_COMMAND" and split_id(m)[1]]
+    if retry:
+        # Gegenstelle kennt keine Nachrichten-IDs: ohne ID wiederholen
+        _peer_no_ids.add(key)
+        for i, reply in zip(retry, pool.send_many(host, port, [strip_id(messages[i]) for i in retry], timeout)):
+            replies[i] = reply
+    return replies
+
+def exchange(host, port, message, timeout=5):
+    reply = send_many(host, port, [message], timeout)[0]
+    if reply == "BUSY":
+        raise PeerBusy(f"{host}:{port} ist ausgelastet (BUSY)")
+    return reply
+
+def send_batch(host, port, auth_key, entries, timeout=5):
+    # entries: [(id, "MSG;...")] (höchstens BATCH_MAX); liefert die IDs der angenommenen
+    # Nachrichten in Sendereihenfolge.
+    key = (host, port)
+    if key not in _peer_no_batch and key not in _peer_legacy:
+        strip = key in _peer_no_ids
+        frame = f"BATCH;{auth_key};" + json.dumps([[str(i), strip_id(m) if strip else m] for i, m in entries])
+        reply = exchange(host, port, frame, timeout)
+        if reply.startswith("BATCH_RECEIVED;"):
+            ids = set(reply[len("BATCH_RECEIVED;"):].split(","))
+            accepted = [i for i, _ in entries if str(i) in ids]
+            # Nichts angenommen, obwohl mit IDs gesendet: evtl. BATCH ohne ID-Unterstützung,
+            # dann klärt der Einzelversand das (und merkt es sich)
+            if accepted or strip or not any(split_id(m)[1] for _, m in entries):
+                return accepted
+        else:
+            _peer_no_batch.add(key)
+    replies = send_many(host, port, [m for _, m in entries], timeout)
+    return [i for (i, _), reply in zip(entries, replies) if reply == "MSG_RECEIVED"]
+
+def udp_ping_many(targets, message, timeout=1.0, attempts=2):
+    # targets: key -> (host, port). Sendet an jedes Ziel "message;<nonce>" als Datagramm und
+    # sammelt "PONG;<nonce>" bis zur Frist; wer nicht antwortet, bekommt das Datagramm bis zu
+    # attempts-mal (gegen Paketverlust). Liefert die Menge der Schlüssel, die geantwortet haben.
+    socks = {}  # Adressfamilie -> Socket
+    pending = {}  # nonce -> (key, socket, Zieladresse)
+    answered = set()
+    try:
+        for key, (host, port) in targets.items():
+            try:
+                family, _, _, _, sockaddr = socket.getaddrinfo(host, port, type=socket.SOCK_DGRAM)[0]
+            except OSError:
+                continue
+            sock = socks.get(family)
+            if sock is None:
+                sock = socks[family] = socket.socket(family, socket.SOCK_DGRAM)
+                sock.setblocking(False)
+            pending[os.urandom(8).hex()] = (key, sock, sockaddr)
+        start = time.time()
+        for attempt in range(1, attempts + 1):
+            for nonce, (key, sock, sockaddr) in pending.items():
+                try:
+                    sock.sendto(f"{message};{nonce}".encode("utf-8"), sockaddr)
+                except OSError:
+                    pass  # z. B. Sendepuffer voll: im nächsten Durchgang erneut
+            round_deadline = start + timeout * attempt / attempts
+            while pending:
+                remaining = round_deadline - time.time()
+                if remaining <= 0:
+                    break
+                readable, _, _ = select.select(list(socks.values()), [], [], remaining)
+                for sock in readable:
+                    try:
+                        data, _ = sock.recvfrom(UDP_MAX_DATAGRAM)
+                    except OSError:
+                        continue
+                    kind, _, nonce = data.decode("utf-8", "replace").partition(";")
+                    if kind == "PONG" and nonce in pending:
+                        answered.add(pending.pop(nonce)[0])
+            if not pending:
+                break
+    finally:
+        for sock in socks.values():
+            sock.close()
+    return answered
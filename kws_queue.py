@@ -0,0 +1,145 @@
+"""
+kws_queue.py – Ausgangswarteschlange
+- Ersetzt die flache Datei data.ksys durch eine Warteschlange pro Ziel im Ordner outbox/.
+- Je Ziel gibt es eine Datei <ziel>.q (nur Anhängen, eine JSON-Zeile pro Nachricht) und
+  eine kleine Zustandsdatei <ziel>.state mit Lese-Offset, Fehlversuchen und nächstem
+  Versuchszeitpunkt (exponentielles Backoff mit Zufallsanteil).
+- Zugestellte Einträge werden nur über den Offset abgehakt; nicht zugestellte Einträge
+  werden nie neu geschrieben. Ist ein Ziel vollständig zugestellt, wird seine Datei geleert.
+- Alte Einträge aus data.ksys werden beim ersten Lauf übernommen (import_legacy_file).
+- MSG/REQ ohne Nachrichten-ID erhalten beim Einreihen eine, damit jede Wiederholung
+  dieselbe ID trägt und der Empfänger Duplikate erkennt.
+"""
+
+import json
+import os
+import random
+import time
+from datetime import datetime
+from urllib.parse import quote, unquote
+
+import kws_proto
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+BACKOFF_BASE = 5  # erstes Warteintervall nach einem Fehlschlag (in Sekunden)
+BACKOFF_MAX = 3600  # obere Grenze des Warteintervalls (in Sekunden)
+
+def _lock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+class Outbox:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _queue_path(self, target):
+        return os.path.join(self.directory, quote(target, safe="") + ".q")
+
+    def _state_path(self, target):
+        return os.path.join(self.directory, quote(target, safe="") + ".state")
+
+    def _load_state(self, target):
+        try:
+            with open(self._state_path(target), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"offset": 0, "failures": 0, "next_attempt": 0}
+
+    def _save_state(self, target, state):
+        path = self._state_path(target)
+        with open(path + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(path + ".tmp", path)
+
+    def enqueue(self, target, message):
+        if message.startswith(("MSG;", "REQ;")):
+            message = kws_proto.with_id(message)
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        record = json.dumps({"time": timestamp, "msg": message}) + "\n"
+        with open(self._queue_path(target), "ab") as f:
+            _lock_file(f)
+            f.write(record.encode("utf-8"))
+
+    def targets(self):
+        return sorted(unquote(name[:-2]) for name in os.listdir(self.directory) if name.endswith(".q"))
+
+    def pending(self, target):
+        # Liste von (End-Offset, Nachricht) aller noch nicht zugestellten Einträge
+        state = self._load_state(target)
+        try:
+            with open(self._queue_path(target), "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                offset = state["offset"] if state["offset"] <= size else 0
+                f.seek(offset)
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        entries = []
+        for line in data.splitlines(keepends=True):
+            if not line.endswith(b"\n"):
+                break  # gerade im Schreiben befindlicher Eintrag
+            offset += len(line)
+            try:
+                entries.append((offset, json.loads(line)["msg"]))
+            except (ValueError, KeyError):
+                continue
+        return entries
+
+    def depth(self, target=None):
+        targets = [target] if target else self.targets()
+        return sum(len(self.pending(t)) for t in targets)
+
+    def due(self, now=None):
+        # Ziele mit offenen Nachrichten, deren Backoff abgelaufen ist
+        now = time.time() if now is None else now
+        result = []
+        for target in self.targets():
+            state = self._load_state(target)
+            if state["next_attempt"] <= now and self._has_pending(target, state):
+                result.append(target)
+        return result
+
+    def _has_pending(self, target, state):
+        try:
+            size = os.path.getsize(self._queue_path(target))
+        except OSError:
+            return False
+        return size > state["offset"] or state["offset"] > size
+
+    def mark_delivered(self, target, offset):
+        with open(self._queue_path(target), "ab") as f:
+            _lock_file(f)
+            if os.fstat(f.fileno()).st_size <= offset:
+                # Alles zugestellt: Datei leeren, solange niemand anhängen kann
+                f.truncate(0)
+                offset = 0
+            self._save_state(target, {"offset": offset, "failures": 0, "next_attempt": 0})
+
+    def mark_failed(self, target):
+        state = self._load_state(target)
+        state["failures"] += 1
+        delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (state["failures"] - 1))
+        state["next_attempt"] = time.time() + delay * random.uniform(0.5, 1.0)
+        self._save_state(target, state)
+        return delay
+
+    def import_legacy_file(self, path):
+        # Einträge im alten Format "<ziel>|<nachricht>|<zeitstempel>" übernehmen und data.ksys leeren
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return 0
+        count = 0
+        with open(path, "r+") as f:
+            _lock_file(f)
+            for line in f:
+                parts = line.strip().split("|")
+                if len(parts) >= 3:
+                    self.enqueue(parts[0], "|".join(parts[1:-1]))
+                    count += 1
+            f.seek(0)
+            f.truncate()
+        return count
@@ -0,0 +1,113 @@
+"""
+kws_relay.py – Routen für die Weiterleitung über Zwischenknoten
+- RouteCache merkt sich, welche Gegenstelle einen Kontakt zuletzt als online gemeldet hat
+  (aus LIST-Antworten und empfangenen ADDLIST-Listen): Ziel -> {Relay: Zeitpunkt}.
+- Einträge verfallen nach ttl Sekunden; gescheiterte Relays werden sofort entfernt, nur
+  ausgelastete (BUSY) nicht.
+- Gespeichert in routes.json im Datenordner, damit kws.py und kws-service.py denselben
+  Stand nutzen. Gleichzeitige Schreiber können sich Einträge überschreiben – für einen
+  Cache genügt das, ein fehlender Eintrag kostet nur den Umweg über die Warteschlange.
+- Weitergeleitet wird mit "REQ;<absender>;<relay>;RELAY;<ziel>;<hops>;MSG;...": das Relay
+  stellt die innere MSG direkt zu, gibt sie (solange hops > 1) an ein eigenes Relay weiter
+  oder legt sie in seine Ausgangswarteschlange.
+"""
+
+import json
+import os
+import threading
+import time
+
+import kws_proto
+
+ROUTE_TTL = 600  # so lange gilt eine gemeldete Route (in Sekunden)
+MAX_RELAYS_PER_TARGET = 8
+
+class RouteCache:
+    def __init__(self, path, ttl=ROUTE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self._routes = {}  # Ziel-auth_id -> {Relay-auth_id: Zeitpunkt}
+        self._signature = None
+
+    def _refresh(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        signature = (st.st_mtime_ns, st.st_size)
+        if signature == self._signature:
+            return
+        try:
+            with open(self.path, "r") as f:
+                self._routes = json.load(f)
+        except (OSError, ValueError):
+            self._routes = {}
+        self._signature = signature
+
+    def _save(self):
+        now = time.time()
+        self._routes = {target: relays for target, relays in
+                        ((t, {r: ts for r, ts in rs.items() if now - ts < self.ttl}) for t, rs in self._routes.items())
+                        if relays}
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._routes, f)
+        os.replace(tmp_path, self.path)
+        st = os.stat(self.path)
+        self._signature = (st.st_mtime_ns, st.st_size)
+
+    def learn(self, relay_auth, contacts):
+        # contacts: Kontaktliste der Gegenstelle relay_auth; deren online Kontakte sind über sie erreichbar
+        now = time.time()
+        with self.lock:
+            self._refresh()
+            for contact in contacts:
+                if contact["status"] != "online" or contact["auth_id"] == relay_auth:
+                    continue
+                relays = self._routes.setdefault(contact["auth_id"], {})
+                relays[relay_auth] = now
+                if len(relays) > MAX_RELAYS_PER_TARGET:
+                    del relays[min(relays, key=relays.get)]
+            self._save()
+
+    def forget(self, target_auth, relay_auth):
+        with self.lock:
+            self._refresh()
+            if self._routes.get(target_auth, {}).pop(relay_auth, None) is not None:
+                self._save()
+
+    def relays_for(self, target_auth, exclude=()):
+        # Relays für ein Ziel, die jüngste Meldung zuerst
+        now = time.time()
+        with self.lock:
+            self._refresh()
+            relays = self._routes.get(target_auth, {})
+            return [r for r, ts in sorted(relays.items(), key=lambda item: -item[1])
+                    if now - ts < self.ttl and r not in exclude]
+
+def relay_candidates(routes, contact_store, target_auth, exclude=()):
+    # Nur Relays, die wir selbst als online kennen (Ping-Ergebnis) und erreichen können
+    candidates = []
+    for relay_auth in routes.relays_for(target_auth, exclude):
+        relay = contact_store.get(relay_auth)
+        if relay and relay["status"] == "online":
+            candidates.append(relay)
+    return candidates
+
+def send_via_relays(routes, contact_store, target_auth, message, auth_key, hops, exclude=(), attempts=3, timeout=5):
+    # Versucht bis zu attempts Relays der Reihe nach; liefert (Relay-Kontakt, Antwort)
+    # bei "RELAYED"/"RELAY_QUEUED", sonst (None, None). Gescheiterte Routen werden vergessen.
+    for relay in relay_candidates(routes, contact_store, target_auth, exclude)[:attempts]:
+        try:
+            host, port = kws_proto.split_address(relay["ip_address"])
+            request = kws_proto.with_id(f"REQ;{auth_key};{relay['auth_id']};RELAY;{target_auth};{hops};{message}")
+            reply = kws_proto.exchange(host, port, request, timeout)
+        except kws_proto.PeerBusy:
+            continue  # Relay nur ausgelastet: Route behalten, nächstes Relay versuchen
+        except Exception:
+            reply = None
+        if reply in ("RELAYED", "RELAY_QUEUED"):
+            return relay, reply
+        routes.forget(target_auth, relay["auth_id"])
+    return None, None
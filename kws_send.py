@@ -0,0 +1,136 @@
+"""
+kws_send.py – Senden an Kontakte
+- Sender bündelt die Sendelogik, die kws-service.py früher selbst enthielt: Nachrichten
+  (mit wartendem Rückstand als BATCH, Weiterleitung über Relays, sonst Warteschlange),
+  REQ-Anfragen und den SYNC-Abgleich.
+- broadcast() sendet dieselbe Nachricht parallel an viele Kontakte (höchstens
+  concurrency gleichzeitig); Fehlschläge landen wie bei message() in der Warteschlange.
+- Wird von kws.py für Befehle über den Steuer-Socket (kws_control.py) und von
+  kws-service.py ohne laufenden kws.py verwendet.
+- Jede Meldung geht an die übergebene log-Funktion (Log-Datei und ggf. Ausgabe).
+"""
+
+import collections
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import kws_contacts
+import kws_proto
+import kws_relay
+from kws_contacts import format_contacts, parse_contacts_from_string
+
+BROADCAST_CONCURRENCY = 32  # gleichzeitige Sendungen einer Rundsendung
+
+class Sender:
+    def __init__(self, contact_store, outbox, routes, log, relay_hops=2, default_port=kws_proto.DEFAULT_PORT):
+        self.contact_store = contact_store
+        self.outbox = outbox
+        self.routes = routes
+        self.log = log
+        self.relay_hops = relay_hops  # 0 = nicht weiterleiten
+        self.default_port = default_port
+
+    def _address(self, ip):
+        return kws_proto.split_address(ip, self.default_port)
+
+    def queue(self, target_ip, message):
+        self.outbox.enqueue(target_ip, message)
+        self.log(f"Nachricht an {target_ip} in Warteschlange gestellt.")
+
+    def request(self, target_ip, target_auth, command, auth_key, payload="", queue=True):
+        # Liefert die Antwort oder None (dann ggf. in der Warteschlange)
+        req = kws_proto.with_id(f"REQ;{auth_key};{target_auth};{command.upper()}")
+        if payload:
+            req += f";{payload}"
+        try:
+            reply = kws_proto.exchange(*self._address(target_ip), req)
+        except Exception as e:
+            # Auch BUSY (PeerBusy): keine Antwort, die Anfrage wird später wiederholt
+            self.log(f"Fehler bei der Anfrage an {target_ip}: {e}")
+            if queue:
+                self.queue(target_ip, req)
+            return None
+        self.log(f"Antwort von {target_ip}: {reply}")
+        self.contact_store.touch(target_auth)
+        if reply.startswith("LIST;"):
+            # Wen die Gegenstelle als online führt, ist notfalls über sie erreichbar
+            self.routes.learn(target_auth, parse_contacts_from_string(reply[len("LIST;"):]))
+        return reply
+
+    def message(self, ip, message, auth_key, target_auth=None):
+        # Liefert "zugestellt", "abgelehnt", "weitergeleitet" oder "in Warteschlange"
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        msg = kws_proto.with_id(f"MSG;{auth_key};{timestamp};{message}")
+        # Rückstand für dieses Ziel zuerst und mit der neuen Nachricht in einem Frame senden
+        backlog = self.outbox.pending(ip)[:kws_proto.BATCH_MAX - 1]
+        if not all(kws_proto.is_msg(m) for _, m in backlog):
+            backlog = []
+        try:
+            accepted = kws_proto.send_batch(*self._address(ip), auth_key, backlog + [("neu", msg)])
+            delivered = 0
+            for offset, _ in backlog:
+                if offset not in accepted:
+                    break
+                delivered = offset
+            if delivered:
+                self.outbox.mark_delivered(ip, delivered)
+                self.log(f"{len(accepted) - ('neu' in accepted)} wartende Nachrichten an {ip} zugestellt.")
+            if "neu" in accepted:
+                self.log(f"Nachricht an {ip} wurde bestätigt.")
+                for contact in self.contact_store.by_ip(ip):
+                    self.contact_store.touch(contact["auth_id"])
+                return "zugestellt"
+            self.log(f"Nachricht an {ip} wurde nicht angenommen.")
+            return "abgelehnt"
+        except Exception as e:
+            self.log(f"Fehler beim Senden an {ip}: {e}")
+        if target_auth and self.relay_hops > 0:
+            relay, reply = kws_relay.send_via_relays(self.routes, self.contact_store, target_auth, msg, auth_key, self.relay_hops)
+            if relay:
+                self.log(f"Nachricht an {ip} über {relay['user_defined_name']} ({relay['ip_address']}) weitergeleitet: {reply}")
+                return "weitergeleitet"
+        self.queue(ip, msg)
+        return "in Warteschlange"
+
+    def broadcast(self, contacts, message, auth_key, concurrency=BROADCAST_CONCURRENCY):
+        # Liefert ({Status: Anzahl}, [(Kontakt, Status) ohne "zugestellt"], Dauer in Sekunden)
+        start = time.perf_counter()
+
+        def send(contact):
+            try:
+                return self.message(contact["ip_address"], message, auth_key, contact["auth_id"])
+            except Exception as e:
+                self.log(f"Fehler beim Senden an {contact['ip_address']}: {e}")
+                return "fehlgeschlagen"
+
+        with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(contacts)))) as executor:
+            results = list(executor.map(send, contacts))
+        counts = collections.Counter(results)
+        failed = [(c, status) for c, status in zip(contacts, results) if status != "zugestellt"]
+        return dict(counts), failed, time.perf_counter() - start
+
+    def sync(self, target_ip, target_auth, auth_key):
+        # Delta-Abgleich: Digest senden, Kontakte der abweichenden Buckets empfangen und
+        # übernehmen, danach nur die eigenen neueren/fehlenden Kontakte per ADDLIST zurück.
+        store = self.contact_store
+        n = kws_contacts.digest_buckets_for(len(store))
+        digest = ",".join(store.digest(n))
+        try:
+            reply = kws_proto.exchange(*self._address(target_ip), kws_proto.with_id(f"REQ;{auth_key};{target_auth};SYNC;{n};{digest}"))
+        except Exception as e:
+            self.log(f"Fehler bei der Anfrage an {target_ip}: {e}")
+            return
+        if not reply.startswith("SYNC;"):
+            self.log(f"SYNC von {target_ip} nicht unterstützt: {reply}")
+            return
+        _, bucket_list, data = reply.split(";", 2)
+        buckets = [int(b) for b in bucket_list.split(",") if b]
+        theirs = {c["auth_id"]: c for c in parse_contacts_from_string(data)}
+        received = store.merge(theirs.values())
+        outgoing = [c for c in store.in_buckets(buckets, n)
+                    if c["auth_id"] not in theirs or kws_contacts.is_newer(c, theirs[c["auth_id"]])]
+        if outgoing:
+            self.request(target_ip, target_auth, "ADDLIST", auth_key, format_contacts(outgoing).strip())
+        self.log(f"SYNC mit {target_ip}: {len(buckets)} von {n} Buckets abweichend, "
+                 f"{received} Kontakte übernommen, {len(outgoing)} gesendet.")
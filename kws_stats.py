@@ -0,0 +1,86 @@
+"""
+kws_stats.py – Laufzeitstatistik
+- Zähler (z. B. Anfragen je Befehl, Bytes ein/aus), Messwerte (z. B. aktive Verbindungen)
+  und Latenz-Histogramme mit festen, logarithmisch gestuften Grenzen in Millisekunden.
+- Erfassung kostet nur ein Lock und eine Addition bzw. eine Binärsuche; ausgewertet
+  wird erst bei der Abfrage (REQ STATS).
+"""
+
+import bisect
+import threading
+import time
+
+# Obergrenzen der Histogramm-Buckets in Millisekunden (der letzte Bucket ist "darüber")
+BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, ms):
+        self.counts[bisect.bisect_left(BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        if ms > self.max_ms:
+            self.max_ms = ms
+
+    def percentile(self, p):
+        # Obergrenze des Buckets, in dem das p-Perzentil liegt
+        if not self.count:
+            return 0.0
+        rank = self.count * p / 100
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return BUCKETS_MS[i] if i < len(BUCKETS_MS) else self.max_ms
+        return self.max_ms
+
+    def format(self):
+        avg = self.total_ms / self.count if self.count else 0.0
+        buckets = ",".join(f"{b}:{n}" for b, n in zip(BUCKETS_MS + ("inf",), self.counts) if n)
+        return (f"count={self.count} avg={avg:.2f}ms p50<={self.percentile(50)}ms "
+                f"p99<={self.percentile(99)}ms max={self.max_ms:.2f}ms buckets={buckets}")
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def incr(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def set(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def get(self, name):
+        with self.lock:
+            return self.gauges.get(name, self.counters.get(name, 0))
+
+    def observe(self, name, seconds):
+        ms = seconds * 1000
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(ms)
+
+    def format(self):
+        # Eine Zeile pro Wert: "name=wert"; Histogramme als zusammengefasste Zeile
+        with self.lock:
+            lines = [f"uptime={time.time() - self.started:.0f}s"]
+            lines += [f"{k}={v}" for k, v in sorted(self.counters.items())]
+            lines += [f"{k}={v}" for k, v in sorted(self.gauges.items())]
+            lines += [f"{k}: {h.format()}" for k, h in sorted(self.histograms.items())]
+        return "\n".join(lines)
+
+# Gemeinsame Instanz eines Prozesses
+stats = Stats()
@@ -0,0 +1,142 @@
+"""
+kws_workers.py – Zusätzliche Server-Prozesse (workers in config.cfk)
+- kws.py startet workers - 1 weitere Prozesse, die mit SO_REUSEPORT auf demselben Port
+  lauschen; der Kernel verteilt eingehende Verbindungen auf alle Prozesse.
+- Nur der Hauptprozess schreibt: Kontaktänderungen (add, merge, touch, update_many) schickt
+  ein Worker über eine Pipe an ihn und wartet auf das Ergebnis (StoreClient/serve_store).
+  Gelesen wird im Worker aus dem eigenen ContactStore, der Snapshot und Journal des
+  Hauptprozesses nachlädt – nach der Antwort steht die Änderung bereits im Journal.
+- Auch die Duplikaterkennung (gesehene Nachrichten-IDs) führt nur der Hauptprozess, da
+  Wiederholungen per SO_REUSEPORT oft bei einem anderen Worker landen (DedupClient): claim
+  prüft und reserviert eine ID in einem Aufruf, die Antwort geht ohne Warten über die Queue.
+- Log-Zeilen und Posteingang gehen ohne Antwort über eine gemeinsame Queue an den
+  Hauptprozess (QueueLog/QueueInbox/drain_events), damit datatrans.ksys und inbox.idx
+  genau einen Schreiber haben.
+- Nur wo fork und SO_REUSEPORT existieren (Linux, BSD, macOS); sonst läuft kws.py wie
+  bisher in einem Prozess.
+"""
+
+import multiprocessing
+import os
+import socket
+import threading
+import time
+
+from kws_contacts import is_fresh
+
+WRITE_METHODS = ("add", "merge", "touch", "update_many")
+DEDUP_METHODS = ("claim",)
+
+def supported():
+    return hasattr(socket, "SO_REUSEPORT") and "fork" in multiprocessing.get_all_start_methods()
+
+class StoreClient:
+    # Kontaktspeicher eines Workers: Lesen lokal, Schreiben über den Hauptprozess
+    def __init__(self, store, conn):
+        self.store = store
+        self.conn = conn
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if name in WRITE_METHODS:
+            return lambda *args: self._call(name, args)
+        return getattr(self.store, name)
+
+    def __len__(self):
+        return len(self.store)
+
+    def _call(self, method, args):
+        with self.lock:
+            self.conn.send((method, args))
+            ok, result = self.conn.recv()
+        if not ok:
+            raise RuntimeError(result)
+        return result
+
+    def touch(self, auth_id, min_interval=60):
+        # Häufigster Fall (gerade erst aufgefrischt) ohne Umweg über den Hauptprozess
+        contact = self.store.get(auth_id)
+        if contact is None or is_fresh(contact, min_interval):
+            return False
+        return self._call("touch", (auth_id, min_interval))
+
+class DedupClient:
+    # Duplikaterkennung eines Workers: claim über dieselbe Pipe wie StoreClient,
+    # remember ohne Antwort über die Queue
+    def __init__(self, store_client, events):
+        self.store_client = store_client
+        self.events = events
+
+    def claim(self, msg_id):
+        return self.store_client._call("claim", (msg_id,))
+
+    def remember(self, msg_id, reply):
+        self.events.put(("dedup", (msg_id, reply)))
+
+def serve_store(store, conn, dedup):
+    # Im Hauptprozess, ein Thread je Worker; dedup: {"claim": ..., "remember": ...}
+    while True:
+        try:
+            method, args = conn.recv()
+        except (EOFError, OSError):
+            return
+        if method in WRITE_METHODS:
+            func = getattr(store, method)
+        elif method in DEDUP_METHODS:
+            func = dedup[method]
+        else:
+            conn.send((False, f"Unbekannte Methode: {method}"))
+            continue
+        try:
+            conn.send((True, func(*args)))
+        except Exception as e:
+            conn.send((False, str(e)))
+
+class QueueLog:
+    # Ersatz für LogWriter im Worker
+    def __init__(self, events):
+        self.events = events
+
+    def write(self, message):
+        self.events.put(("log", message))
+
+class QueueInbox:
+    # Ersatz für kws_inbox.Inbox im Worker (nur append)
+    def __init__(self, events):
+        self.events = events
+
+    def append(self, sender_auth, sent, text):
+        self.events.put(("inbox", (sender_auth, sent, text)))
+
+def drain_events(events, log, inbox, dedup):
+    # Im Hauptprozess: Log-Zeilen, Nachrichten und Antworten zu Nachrichten-IDs der Worker übernehmen
+    while True:
+        kind, value = events.get()
+        if kind == "log":
+            log(value)
+        elif kind == "inbox":
+            inbox.append(*value)
+        elif kind == "dedup":
+            dedup["remember"](*value)
+
+def watch_parent(parent_pid):
+    # Worker beenden, wenn der Hauptprozess nicht mehr existiert
+    while os.getppid() == parent_pid:
+        time.sleep(1)
+    os._exit(0)
+
+def start_workers(count, target, auth_key, store, log, inbox, dedup):
+    # Startet count Worker-Prozesse target(auth_key, conn, events) und die zugehörigen
+    # Threads im Hauptprozess; muss vor dem Start weiterer Threads aufgerufen werden
+    ctx = multiprocessing.get_context("fork")
+    events = ctx.Queue()
+    processes = []
+    for _ in range(count):
+        parent_conn, child_conn = ctx.Pipe()
+        process = ctx.Process(target=target, args=(auth_key, child_conn, events), daemon=True)
+        process.start()
+        child_conn.close()
+        threading.Thread(target=serve_store, args=(store, parent_conn, dedup), daemon=True).start()
+        processes.append(process)
+    threading.Thread(target=drain_events, args=(events, log, inbox, dedup), daemon=True).start()
+    return processes